@@ -0,0 +1,95 @@
+doc="""
+Benchmark the tile geometry for predicting with a trained model.
+Sweeps tile width, border (overlap) and batch size on a sample image, measures useful pixels per second
+and peak memory, and writes the fastest configuration to `<traindir>/predict_params.json`,
+which predict.get_model_params_from_dir picks up from then on.
+
+usage: python autotune.py traindir sample.tif
+"""
+
+import sys
+import time
+import json
+import tracemalloc
+import resource
+
+import numpy as np
+import skimage.io as io
+from tabulate import tabulate
+
+import unet
+import predict
+import patchmaker
+
+autotune_params = {
+ 'widths' : [256, 384, 512, 768, 1024, 1536],
+ ## extra border on top of the smallest valid one, in units of 2**n_pool
+ 'extra_borders' : [0, 1],
+ 'batch_sizes' : [1, 2, 4, 8],
+ 'repeats' : 2,
+}
+
+def benchmark(model, img, pp, repeats=2):
+    """
+    Time predict_single_image on img with the tile geometry in pp.
+    returns (useful pixels per second, peak MB of numpy allocations during the run)
+    """
+    ## warm up, so graph building / shape specific setup isn't timed
+    w = pp['width']
+    tile = patchmaker.extract_patch(img, (0, 0), (w, w))
+    predict.predict_tiles(model, tile[np.newaxis], pp)
+    tracemalloc.start()
+    t = time.time()
+    for _ in range(repeats):
+        predict.predict_single_image(model, img, pp)
+    dt = (time.time() - t) / repeats
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return img.shape[0]*img.shape[1] / dt, peak / 2**20
+
+def sweep_widths(widths, shape, min_border, g):
+    """
+    the widths worth trying on an image of shape: wider tiles than the image plus borders only add padding.
+    If the image is smaller than every width we try the smallest multiple of g covering it.
+    """
+    covering = -(-(max(shape) + 2*min_border) // g) * g
+    return [w for w in widths if w <= covering + g] or [covering]
+
+def autotune(direc, img, atp=autotune_params):
+    pp, model = predict.load_model_from_dir(direc)
+    pp['auto_tile'] = False
+    g = 2**pp['n_pool']
+    ## not pp['border'], which already comes from a previous predict_params.json
+    min_border = predict.min_border(pp['itd'], pp['n_pool'])
+    budget = pp.get('activation_budget_mb', 4096) * 2**20
+
+    table = []
+    for width in sweep_widths(atp['widths'], img.shape, min_border, g):
+        for extra in atp['extra_borders']:
+            border = min_border + extra*g
+            if width - 2*border < g:
+                continue
+            for batch_size in atp['batch_sizes']:
+                act = unet.activation_bytes((width, width), pp['n_pool'], pp['n_convolutions_first_layer'], pp['n_classes'], batch_size)
+                if act > budget:
+                    continue
+                p = dict(pp, width=width, border=border, step=width-2*border, batch_size=batch_size)
+                px_per_s, peak_mb = benchmark(model, img, p, atp['repeats'])
+                table.append([width, border, batch_size, px_per_s, peak_mb, act/2**20])
+                print(table[-1])
+
+    if not table:
+        sys.exit("No tile geometry fits the activation budget of {} MB, predict_params.json not written.".format(budget // 2**20))
+
+    headers = ['width', 'border', 'batch_size', 'px_per_s', 'peak_mb', 'activation_mb']
+    table.sort(key=lambda row: -row[3])
+    print(tabulate(table, headers=headers))
+    print("max rss (MB): ", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10)
+
+    best = dict(zip(headers, table[0]))
+    json.dump(best, open(direc + '/predict_params.json', 'w'))
+    print("Best: ", best)
+    return best, table
+
+if __name__ == '__main__':
+    autotune(sys.argv[1], io.imread(sys.argv[2]))
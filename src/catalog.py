@@ -0,0 +1,235 @@
+doc="""
+A persistent catalog of every tif under our data directories, in a local SQLite database, so scripts
+can find images with a query instead of globbing (or os.walking) the network filesystem every time.
+For each tif we store path, mtime, size, shape, dtype, downscale factor, role (grey / label / prediction)
+and intensity statistics. `update(root)` re-reads only new or modified files (by mtime) and drops deleted ones.
+`cglob(pattern)` answers glob patterns under indexed roots from the catalog, and falls back to a real glob
+elsewhere. It re-indexes the pattern's directory first when that directory changed since its last update,
+but files added deeper down (below a wildcard) are only seen after an update of their root!
+
+usage: python catalog.py root [root ...]
+"""
+
+import os
+import re
+import sys
+import time
+import json
+import sqlite3
+import fnmatch
+from glob import glob
+import numpy as np
+import tifffile
+
+import tiffio
+
+catalog_params = {
+ 'db' : 'catalog.sqlite',
+ ## compute intensity statistics (reads every pixel of new images once)
+ 'stats' : True,
+}
+
+schema = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    mtime REAL, size INTEGER,
+    shape TEXT, dtype TEXT,
+    downscale INTEGER, role TEXT,
+    min REAL, max REAL, mean REAL, std REAL
+);
+CREATE INDEX IF NOT EXISTS images_role ON images (role, downscale);
+CREATE TABLE IF NOT EXISTS roots (path TEXT PRIMARY KEY, updated REAL);
+CREATE TABLE IF NOT EXISTS histograms (path TEXT PRIMARY KEY, mtime REAL, lo REAL, hi REAL, counts BLOB);
+"""
+
+def connect(db=None):
+    con = sqlite3.connect(db or catalog_params['db'])
+    con.executescript(schema)
+    return con
+
+def normpath(path):
+    return os.path.normpath(path).replace(os.sep, '/')
+
+## what we can tell from the path alone
+
+def infer_downscale(path):
+    "the downscale factor from the directory names, e.g. down3x, smaller2x, small3x, mean8"
+    m = re.findall(r'(?:down|smaller|small)(\d+)x|mean(\d+)', path)
+    if not m:
+        return 1
+    a, b = m[-1]
+    return int(a or b)
+
+def infer_role(path):
+    """
+    'prediction', 'label' or 'grey' from the path components: labels live in labels* directories
+    (labels, labels_big) or are named *_seg.tif / *_masks.tif / *_label*.tif.
+    The labeled_data_* directories hold both, so they don't count.
+    """
+    parts = normpath(path).lower().split('/')
+    dirs, name = parts[:-1], parts[-1]
+    if 'predict' in name:
+        return 'prediction'
+    if any(d.startswith('labels') for d in dirs):
+        return 'label'
+    if re.search(r'_(seg|masks|label\w*)\.tif$', name):
+        return 'label'
+    return 'grey'
+
+def intensity_stats(img, rows=512):
+    "min, max, mean, std of img, a block of rows at a time (img may be memory-mapped or lazy)"
+    mi, ma, s, s2, n = np.inf, -np.inf, 0., 0., 0
+    for i in range(0, img.shape[0], rows):
+        block = np.asarray(img[i:i+rows], dtype=np.float64)
+        mi, ma = min(mi, block.min()), max(ma, block.max())
+        s += block.sum()
+        s2 += (block**2).sum()
+        n += block.size
+    mean = s / n
+    return float(mi), float(ma), float(mean), float(np.sqrt(max(s2/n - mean**2, 0)))
+
+def describe(path, stats=True):
+    "the catalog row of the tif at path"
+    st = os.stat(path)
+    with tifffile.TiffFile(path) as tif:
+        series = tif.series[0]
+        shape, dtype = tuple(series.shape), str(series.dtype)
+    row = {'path' : normpath(path), 'mtime' : st.st_mtime, 'size' : st.st_size,
+           'shape' : json.dumps(shape), 'dtype' : dtype,
+           'downscale' : infer_downscale(path), 'role' : infer_role(path),
+           'min' : None, 'max' : None, 'mean' : None, 'std' : None}
+    if stats:
+        row['min'], row['max'], row['mean'], row['std'] = intensity_stats(tiffio.imread_lazy(path))
+    return row
+
+## keeping the catalog up to date
+
+def scan(root):
+    "(path, mtime) of every tif under root"
+    stack = [root]
+    while stack:
+        d = stack.pop()
+        for e in os.scandir(d):
+            if e.is_dir():
+                stack.append(e.path)
+            elif e.name.endswith('.tif'):
+                yield normpath(e.path), e.stat().st_mtime
+
+def update(root, cp=catalog_params):
+    """
+    Bring the catalog up to date with the tifs under root: describe new and modified files (by mtime),
+    forget deleted ones. Unreadable files are reported and skipped.
+    """
+    con = connect(cp['db'])
+    root = normpath(root)
+    ## files changed while we scan make the root look stale, not fresh
+    started = time.time()
+    known = dict(con.execute("SELECT path, mtime FROM images WHERE path GLOB ?", (glob_escape(root) + '/*',)))
+    seen = set()
+    n_new = 0
+    for path, mtime in scan(root):
+        seen.add(path)
+        if known.get(path) == mtime:
+            continue
+        try:
+            row = describe(path, cp['stats'])
+        except Exception as e:
+            print("Can't read: ", path, e)
+            continue
+        con.execute("INSERT OR REPLACE INTO images VALUES (:path, :mtime, :size, :shape, :dtype, :downscale, :role, :min, :max, :mean, :std)", row)
+        n_new += 1
+        if n_new % 100 == 0:
+            con.commit()
+            print(n_new, "new or modified images")
+    gone = [p for p in known if p not in seen]
+    con.executemany("DELETE FROM images WHERE path = ?", [(p,) for p in gone])
+    con.execute("INSERT OR REPLACE INTO roots VALUES (?, ?)", (root, started))
+    con.commit()
+    con.close()
+    print("{}: {} new or modified, {} deleted, {} total".format(root, n_new, len(gone), len(seen)))
+
+## queries
+
+def glob_escape(s):
+    "escape the SQL GLOB special characters of s"
+    return re.sub(r'([*?\[])', r'[\1]', s)
+
+def glob_match(pattern, path):
+    "shell glob semantics: * and ? don't cross directory boundaries (SQL GLOB's do)"
+    p, q = pattern.split('/'), path.split('/')
+    return len(p) == len(q) and all(fnmatch.fnmatchcase(b, a) for a, b in zip(p, q))
+
+def query(pattern='*', role=None, downscale=None, recursive=False, cp=catalog_params):
+    """
+    sorted paths in the catalog matching the glob pattern and, if given, role and downscale.
+    recursive: * matches across directories, e.g. query('data3/*.tif', recursive=True) finds all tifs under data3.
+    """
+    pattern = normpath(pattern)
+    sql = "SELECT path FROM images WHERE path GLOB ?"
+    args = [pattern]
+    if role is not None:
+        sql += " AND role = ?"
+        args.append(role)
+    if downscale is not None:
+        sql += " AND downscale = ?"
+        args.append(downscale)
+    con = connect(cp['db'])
+    paths = [r[0] for r in con.execute(sql + " ORDER BY path", args)]
+    con.close()
+    if recursive:
+        return paths
+    return [p for p in paths if glob_match(pattern, p)]
+
+def indexed_root(pattern, cp=catalog_params):
+    "the innermost indexed root containing pattern and the time it was last updated, or (None, None)"
+    if not os.path.exists(cp['db']):
+        return None, None
+    con = connect(cp['db'])
+    roots = list(con.execute("SELECT path, updated FROM roots ORDER BY length(path) DESC"))
+    con.close()
+    pattern = normpath(pattern)
+    for r, updated in roots:
+        if pattern == r or pattern.startswith(r + '/'):
+            return r, float(updated)
+    return None, None
+
+def fixed_dir(pattern):
+    "the directory part of pattern up to its first glob character"
+    fixed = []
+    for part in normpath(pattern).split('/')[:-1]:
+        if re.search(r'[*?\[]', part):
+            break
+        fixed.append(part)
+    return '/'.join(fixed) or '.'
+
+def refresh(pattern, cp=catalog_params):
+    """
+    True if the catalog can answer pattern: it is under an indexed root, and its fixed directory
+    (see fixed_dir) is re-indexed first if it was modified since that root was updated.
+    That's one stat, and it only sees files added to or removed from the fixed directory itself.
+    """
+    root, updated = indexed_root(pattern, cp)
+    if root is None:
+        return False
+    d = fixed_dir(pattern)
+    if not os.path.isdir(d):
+        return False
+    if os.path.getmtime(d) > updated:
+        update(d, cp)
+    return True
+
+def cglob(pattern, cp=catalog_params):
+    "sorted(glob(pattern)), from the catalog when pattern is under an indexed root"
+    if pattern.endswith('.tif') and refresh(pattern, cp):
+        return query(pattern, cp=cp)
+    return sorted(glob(pattern))
+
+def files(root, pattern='*.tif', cp=catalog_params):
+    "all tifs under root matching pattern (in any subdirectory), indexing root first if we haven't yet"
+    if not refresh(os.path.join(root, pattern), cp):
+        update(root, cp)
+    return [p for p in query(glob_escape(normpath(root)) + '/*', recursive=True, cp=cp) if fnmatch.fnmatchcase(os.path.basename(p), pattern)]
+
+if __name__ == '__main__':
+    for root in sys.argv[1:]:
+        update(root)
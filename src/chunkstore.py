@@ -0,0 +1,201 @@
+doc="""
+A chunked on-disk training stack, replacing the monolithic stakk tifs which have to be decompressed
+into RAM whole before we can use a single patch.
+A chunked stakk is a directory with
+  - data.bin   : the patches, one chunk per patch, each (2, a, b) = (grey, label), optionally zlib compressed.
+  - index.json : patch shape, dtype, compression, the (offset, nbytes) of every chunk, and per-patch
+                 statistics (see patch_stats), so we can select patches without reading any data.
+Uncompressed stakks are memory-mapped. Reading a selection of patches touches only their chunks.
+For old stakk tifs the same statistics are kept in a sidecar `<stakk>.stats.json`, and selected
+patches are read page by page.
+"""
+
+import os
+import json
+import zlib
+import numpy as np
+import tifffile
+
+def is_chunked(path):
+    return os.path.isfile(os.path.join(path, 'index.json'))
+
+def n_membrane(lab, membrane_labels=(1,2)):
+    return int(np.isin(lab, membrane_labels).sum())
+
+def patch_stats(patch):
+    "per-patch statistics of a (grey, label) patch: membrane pixel count and grey percentiles p1, p50, p99"
+    p1, p50, p99 = np.percentile(patch[0], [1, 50, 99])
+    return {'n_membrane' : n_membrane(patch[1]), 'p1' : float(p1), 'p50' : float(p50), 'p99' : float(p99)}
+
+def top_k(values, k):
+    "indices of the k largest values (in no particular order), without sorting all of them"
+    if k < 0 or k >= len(values):
+        return np.arange(len(values))
+    return np.argpartition(values, len(values) - k)[len(values) - k:]
+
+class ChunkWriter(object):
+    """
+    Write a chunked stakk one patch at a time, so the whole stakk never has to be in memory.
+    compress is the zlib level, 0 for none.
+    If path already holds a chunked stakk we append to it (patch_shape and dtype must match),
+    dropping any data written after its index was last saved. Stakks without a sources index
+    (written before we kept one) can't be appended to.
+    """
+    def __init__(self, path, patch_shape, dtype, compress=0):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        fname = os.path.join(path, 'data.bin')
+        if is_chunked(path):
+            self.index = json.load(open(os.path.join(path, 'index.json')))
+            if self.index['patch_shape'] != list(patch_shape) or self.index['dtype'] != np.dtype(dtype).str:
+                raise ValueError("can't append {} {} patches to {}".format(patch_shape, dtype, path))
+            ## stakks written before we kept track of their source images
+            if 'sources' not in self.index:
+                if self.index['chunks']:
+                    raise ValueError("{} has no sources index, can't tell which images it holds. Rebuild it from scratch.".format(path))
+                self.index['sources'] = {}
+            self.pad_meta()
+            self.offset = sum(self.index['chunks'][-1]) if self.index['chunks'] else 0
+            self.data = open(fname, 'r+b')
+            self.data.truncate(self.offset)
+            self.data.seek(self.offset)
+        else:
+            self.index = {'patch_shape' : list(patch_shape),
+                          'dtype' : np.dtype(dtype).str,
+                          'compress' : compress,
+                          'chunks' : [],
+                          'meta' : {},
+                          ## source image -> shape, for every image we're done with
+                          'sources' : {},
+                          }
+            self.data = open(fname, 'wb')
+            self.offset = 0
+
+    def append(self, patch, **meta):
+        "patch (2, a, b) = (grey, label). meta are per-patch values, e.g. n_membrane=..."
+        buf = np.ascontiguousarray(patch, dtype=self.index['dtype']).tobytes()
+        if self.index['compress']:
+            buf = zlib.compress(buf, self.index['compress'])
+        self.data.write(buf)
+        self.index['chunks'].append([self.offset, len(buf)])
+        self.offset += len(buf)
+        n = len(self.index['chunks'])
+        for k, v in meta.items():
+            self.index['meta'].setdefault(k, [None]*(n-1)).append(v)
+        self.pad_meta()
+
+    def pad_meta(self):
+        "pad the meta values missing for some patches (e.g. a key new in this append) with None"
+        n = len(self.index['chunks'])
+        for v in self.index['meta'].values():
+            v.extend([None]*(n - len(v)))
+
+    def extend(self, patches, **meta):
+        "append a stack of patches (N, 2, a, b), with their patch_stats. meta values are lists of length N"
+        for i, p in enumerate(patches):
+            self.append(p, **patch_stats(p), **{k : v[i] for k, v in meta.items()})
+
+    def add_source(self, name, shape, patches, coords):
+        "append all the patches cut from image name (of shape) at coords, and mark the image as done"
+        self.extend(patches, source=[name]*len(patches), coords=np.asarray(coords).tolist())
+        self.index['sources'][name] = list(shape)
+        self.flush()
+
+    def flush(self):
+        "make everything appended so far durable. The index is replaced atomically, after the data."
+        self.data.flush()
+        os.fsync(self.data.fileno())
+        tmp = os.path.join(self.path, 'index.json.tmp')
+        json.dump(self.index, open(tmp, 'w'))
+        os.replace(tmp, os.path.join(self.path, 'index.json'))
+
+    def close(self):
+        self.flush()
+        self.data.close()
+
+def meta_array(values):
+    "per-patch meta values as an array, an object array if some patches have none (see ChunkWriter.pad_meta)"
+    if not any(v is None for v in values):
+        return np.array(values)
+    a = np.empty(len(values), dtype=object)
+    for i, v in enumerate(values):
+        a[i] = v
+    return a
+
+class ChunkedStakk(object):
+    """
+    A lazily opened chunked stakk. stakk[inds] reads only the chunks in inds.
+    stakk.meta['n_membrane'] etc. (see patch_stats) are available without reading any patches.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index = json.load(open(os.path.join(path, 'index.json')))
+        self.patch_shape = tuple(self.index['patch_shape'])
+        self.dtype = np.dtype(self.index['dtype'])
+        self.chunks = np.array(self.index['chunks'], dtype=np.int64).reshape((-1, 2))
+        self.meta = {k : meta_array(v) for k, v in self.index['meta'].items()}
+        self.shape = (len(self.chunks),) + self.patch_shape
+        fname = os.path.join(path, 'data.bin')
+        if self.index['compress']:
+            self.data = open(fname, 'rb')
+        elif len(self.chunks):
+            self.data = np.memmap(fname, dtype=self.dtype, mode='r', shape=self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read(self, i):
+        if not self.index['compress']:
+            return self.data[i]
+        offset, nbytes = self.chunks[i]
+        self.data.seek(offset)
+        buf = zlib.decompress(self.data.read(nbytes))
+        return np.frombuffer(buf, dtype=self.dtype).reshape(self.patch_shape)
+
+    def __getitem__(self, inds):
+        "the patches inds (an int, a slice or an index array), read in file order"
+        if np.isscalar(inds):
+            return np.array(self.read(inds))
+        inds = np.arange(len(self))[inds]
+        out = np.empty((len(inds),) + self.patch_shape, dtype=self.dtype)
+        for j in np.argsort(inds, kind='mergesort'):
+            out[j] = self.read(inds[j])
+        return out
+
+def write_stakk(path, stakk, compress=0):
+    "write an in-memory stakk (N, 2, a, b) as a chunked stakk"
+    w = ChunkWriter(path, stakk.shape[1:], stakk.dtype, compress)
+    w.extend(stakk)
+    w.close()
+    return ChunkedStakk(path)
+
+## old stakk tifs (N, 2, a, b), stored as N*2 pages
+
+def tif_stakk_stats(fname):
+    """
+    The patch_stats of every patch in a stakk tif, as a dict of arrays.
+    Computed once, reading one patch at a time, and cached in the sidecar fname + '.stats.json'.
+    """
+    sidecar = fname + '.stats.json'
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(fname):
+        stats = json.load(open(sidecar))
+    else:
+        stats = {}
+        with tifffile.TiffFile(fname) as tif:
+            for i in range(len(tif.pages)//2):
+                patch = np.stack([tif.pages[2*i].asarray(), tif.pages[2*i+1].asarray()])
+                for k, v in patch_stats(patch).items():
+                    stats.setdefault(k, []).append(v)
+        json.dump(stats, open(sidecar, 'w'))
+    return {k : np.array(v) for k, v in stats.items()}
+
+def read_tif_stakk(fname, inds):
+    "the patches inds (N, 2, a, b) of a stakk tif, reading only their pages"
+    inds = np.asarray(inds)
+    keys = np.stack([2*inds, 2*inds+1], axis=1).ravel()
+    order = np.argsort(keys, kind='mergesort')
+    data = tifffile.imread(fname, key=keys[order].tolist())
+    data = data.reshape((len(keys),) + data.shape[-2:])
+    pages = np.empty_like(data)
+    pages[order] = data
+    return pages.reshape((len(inds), 2) + data.shape[-2:])
@@ -1,13 +1,19 @@
 import os
-from glob import glob
+import multiprocessing
 import skimage.io as io
 import numpy as np
 import util
 import patchmaker
+import tiffio
+import chunkstore
+import preproc_cache
+import pyramid
+import catalog
 import skimage.exposure as expo
 
 def sglob(string):
-    return sorted(glob(string))
+    "sorted glob, answered from the image catalog when we've indexed the directory (see catalog)"
+    return catalog.cglob(string)
 
 knime_train_data_greys_bgblack         = lambda : sglob("data/knime_test_data/data/train/greyscale_bg_removed/bg_removed?.tif")
 knime_train_data_greys                 = lambda : sglob("data/knime_test_data/data/train/grayscale/grayscale_?.tif")
@@ -59,7 +65,7 @@ seg_labels_small3x = lambda : sglob("data3/labeled_data_cellseg/labels/down3x/*.
 seg_labels_small6x = lambda : sglob("data3/labeled_data_cellseg/labels/down6x/*.tif")
 
 # EXTRA DATA: full-size greyscale and label images annotated by cell segmentation pipeline 
-seg_images_extra = sglob("data3/labeled_data_cellseg/greyscales/*timeseries*/*.tif")
+seg_images_extra = lambda : sglob("data3/labeled_data_cellseg/greyscales/*timeseries*/*.tif")
 
 
 def split_in_half_for_train_test(grey_imgs, label_imgs):
@@ -83,59 +89,85 @@ def split_in_half_for_train_test(grey_imgs, label_imgs):
     X_vali, Y_vali  = imglists_to_XY(grey_rightside, label_rightside)
     return X_train,Y_train,X_vali,Y_vali
 
-def build_stakk():
+stakk_step  = 256
+stakk_width = 256 # must be factor of 2^d, d=n_maxpooling (across all models!)
+
+def image_patches(pair):
+    """
+    The (grey, label) patches (N, 2, width, width) of one image pair for build_stakk.
+    returns grey name, image shape, patch coords, patches
+    """
+    a, b = pair
+    lab = tiffio.imread_lazy(b) # only ever sliced into patches
+    # lab = lab[1]
+
+    ## normalize each image to [0,1]. Don't get rid of bright outliers!
+    ## This is the slowest step, so it's cached by image content (see preproc_cache).
+    img = preproc_cache.cached(a, expo.equalize_adapthist, kernel_size=[10,10])
+    # img = img.astype('float32')
+    # img -= img.min()
+    # img /= img.max()
+
+    coords = patchmaker.square_grid_coords(img, stakk_step)
+    img_pat = patchmaker.sample_patches_from_img(coords, img, (stakk_width, stakk_width))
+
+    ## normalize each X patch
+    # img_pat -= img_pat.min(axis=(1,2), keepdims=True)
+    # img_pat = img_pat.astype('uint16')
+    # img_pat *= (2**16-1)//img_pat.max(axis=(1,2), keepdims=True)
+
+    lab_pat = patchmaker.sample_patches_from_img(coords, lab, (stakk_width, stakk_width))
+    patches = np.stack([img_pat, lab_pat], axis=1).astype('float32')
+    return a, img.shape, coords, patches
+
+def build_stakk(savename=None, compress=0, n_procs=4):
+    """
+    Cut the membrane images into a stakk of (grey, label) patches, shape (N, 2, width, width).
+    Images are processed in parallel in n_procs processes.
+    With a savename, each image's patches are appended to a chunked stakk (see chunkstore) with zlib level
+    compress as soon as they're ready, together with their source image and coords, and the opened
+    ChunkedStakk is returned instead of an array. Images already in the chunked stakk are skipped,
+    so re-running after adding images (or after a crash) only processes the new ones.
+    returns stakk, sizes (the shapes of the images in the stakk)
+    """
     greys  = sglob("/Volumes/Coleman_Pocket/Carine_project/data3/labeled_data_membranes/images_big/smaller2x/*.tif")
     labels = sglob("/Volumes/Coleman_Pocket/Carine_project/data3/labeled_data_membranes/labels_big/smaller2x/*.tif")
-    count = 0
     end = None
-    step = 256
-    width = 256 # must be factor of 2^d, d=n_maxpooling (across all models!)
-    stakk = []
-    sizes = []
-    for a,b in zip(greys[:end], labels[:end]):
-        img = io.imread(a)
-        lab = io.imread(b)
-        # lab = lab[1]
-
-        ## normalize each image to [0,1]. Don't get rid of bright outliers!
-        img = expo.equalize_adapthist(img, [10,10])
-        # img = img.astype('float32')
-        # img -= img.min()
-        # img /= img.max()
-
-        sizes.append(img.shape)
-        coords = patchmaker.square_grid_coords(img, step)
-        img_pat = patchmaker.sample_patches_from_img(coords, img, (width, width))
-        
-        ## normalize each X patch
-        # img_pat -= img_pat.min(axis=(1,2), keepdims=True)
-        # img_pat = img_pat.astype('uint16')
-        # img_pat *= (2**16-1)//img_pat.max(axis=(1,2), keepdims=True)
-        
-        lab_pat = patchmaker.sample_patches_from_img(coords, lab, (width, width))
-        patches = np.stack([img_pat, lab_pat], axis=1)
-        stakk.append(patches)
-        count += 1
-    stakk = np.concatenate(stakk, axis=0)
-    return stakk, sizes
+    pairs = list(zip(greys[:end], labels[:end]))
+    pool = multiprocessing.Pool(n_procs)
+
+    if not savename:
+        results = pool.map(image_patches, pairs)
+        pool.close()
+        stakk = np.concatenate([r[3] for r in results], axis=0)
+        return stakk, [r[1] for r in results]
+
+    writer = chunkstore.ChunkWriter(savename, (2, stakk_width, stakk_width), 'float32', compress)
+    todo = [p for p in pairs if p[0] not in writer.index['sources']]
+    print("Building stakk from {} new images ({} already done)".format(len(todo), len(pairs) - len(todo)))
+    for name, shape, coords, patches in pool.imap_unordered(image_patches, todo):
+        writer.add_source(name, shape, patches, coords)
+        print("Added", patches.shape[0], "patches from", name)
+    pool.close()
+    writer.close()
+    return chunkstore.ChunkedStakk(savename), list(writer.index['sources'].values())
 
 def get_all_big_tifs(basedir):
+    "all full size tifs under basedir, from the image catalog (which indexes basedir the first time)"
     count = 0
     tiflist = []
-    for a,b,c in os.walk(basedir):
-        for imgName in c:
-            if imgName.endswith(".tif") and 'down' not in a:
-                if 'timeseries' in imgName and 'MembraneMiddle' in imgName:
-                    if 'zoomed' in imgName:
-                        count += 1
-                        d_name = os.path.join(a, imgName)
-                        print(d_name)
-                        tiflist.append(d_name)
-                else:
+    for d_name in catalog.files(basedir):
+        a, imgName = os.path.split(d_name)
+        if 'down' not in a:
+            if 'timeseries' in imgName and 'MembraneMiddle' in imgName:
+                if 'zoomed' in imgName:
                     count += 1
-                    d_name = os.path.join(a, imgName)
                     print(d_name)
                     tiflist.append(d_name)
+            else:
+                count += 1
+                print(d_name)
+                tiflist.append(d_name)
     print(count)
     return tiflist
 
@@ -168,28 +200,12 @@ def make_prediction_overlays():
     map(save, pairs)
 
 def max_pool_downscale():
-    from skimage.util import view_as_windows
-    def pooled3(img):
-        # img[img==0] = 2000 # so that membrane is 1 is the min value
-        print("shape: ", img.shape)
-        img = view_as_windows(img, 6, step=6)
-        img = np.max(img, axis=(2,3))
-        # now permute back
-        # img[img==2000] = 0
-        return img
-    util.apply_operation_to_imgdir("data2/labels/", pooled3)
+    "labels downscaled 2x, 3x and 6x by max pooling, see pyramid.build_pyramid"
+    pyramid.build_pyramid("data2/labels/", (2,3,6), kind='max')
 
 def mean_downscale():
-    from skimage.util import view_as_windows
-    def down3x(img):
-        s = img.shape
-        print("shape: ", img.shape)
-        # if s[0] > s[1]:
-        # img = np.transpose(img)
-        img = view_as_windows(img, 3, step=3)
-        img = np.mean(img, axis=(2,3)).astype(np.float32)
-        return img/img.max()
-    util.apply_operation_to_imgdir("data2/greyscales/", down3x)
+    "greyscales downscaled 2x, 3x and 6x by block means, see pyramid.build_pyramid"
+    pyramid.build_pyramid("data2/greyscales/", (2,3,6), kind='mean', normalize=True)
 
 def strip_channel():
 	from util import path_base_ext
@@ -0,0 +1,74 @@
+doc="""
+Keep inference-ready unet models in memory, so repeated predictions don't rebuild the graph and
+reload the weights every time. Models are keyed by the absolute path and mtime of their weights file
+(plus the architecture params), so retraining into the same directory invalidates the entry.
+The least recently used models are evicted when we hold more than `max_models` models.
+NOTE: every model is built in the shared keras backend session, and evicting it only drops our
+reference, the session keeps its graph and weights. So eviction doesn't bound memory!
+Call clear() (which resets the backend session) between batches of many different models.
+"""
+
+import os
+from collections import OrderedDict
+from keras import backend as K
+
+import unet
+
+registry_params = {
+ 'max_models' : 4,
+}
+
+arch_keys = ['n_pool', 'n_classes', 'n_convolutions_first_layer', 'dropout_fraction']
+
+_models = OrderedDict()
+
+def model_key(params):
+    weights = params['initial_model_params']
+    arch = tuple(params[k] for k in arch_keys)
+    if not weights:
+        return (None, None, arch)
+    weights = os.path.abspath(weights)
+    return (weights, os.path.getmtime(weights), arch)
+
+def get_model(params):
+    """
+    Returns the model described by params (n_pool, n_classes, n_convolutions_first_layer, dropout_fraction
+    and initial_model_params, as in train.get_model), from memory if we have it.
+    Don't train the returned model! It is shared with every other caller.
+    """
+    key = model_key(params)
+    if key in _models:
+        _models.move_to_end(key)
+        return _models[key]
+
+    ## drop stale entries for older versions of the same weights file
+    for k in [k for k in _models if k[0] == key[0] and k[0] is not None]:
+        del _models[k]
+
+    model = unet.get_unet_n_pool(params['n_pool'],
+                                 n_classes = params['n_classes'],
+                                 n_convolutions_first_layer = params['n_convolutions_first_layer'],
+                                 dropout_fraction = params['dropout_fraction'])
+    if key[0]:
+        model.load_weights(key[0])
+    ## build the predict function now, this also makes the model safe to call from other threads
+    if hasattr(model, '_make_predict_function'):
+        model._make_predict_function()
+    _models[key] = model
+    evict()
+    return model
+
+def evict():
+    "drop least recently used models until we're within registry_params"
+    rp = registry_params
+    while len(_models) > rp['max_models']:
+        key, _ = _models.popitem(last=False)
+        print("Evicting model: ", key[0])
+
+def clear():
+    """
+    Forget all models and reset the keras backend session, which frees their graphs and weights.
+    Models you still hold (from get_model or elsewhere, e.g. one you're training) are unusable afterwards.
+    """
+    _models.clear()
+    K.clear_session()
@@ -0,0 +1,73 @@
+doc="""
+Per-image intensity histograms, computed once in a streaming pass and stored in the image catalog
+(see catalog), so percentile and mode based normalization of whole images costs a lookup instead of
+sorting pixels. A histogram has n_bins equal bins between the image min and max; percentiles are
+interpolated inside the bins.
+"""
+
+import os
+import numpy as np
+
+import catalog
+import tiffio
+
+n_bins = 4096
+
+def streaming_histogram(img, bins=n_bins, rows=512):
+    """
+    (counts, lo, hi) of img, a block of rows at a time (img may be memory-mapped or lazy).
+    Two passes: one for the range, one for the counts.
+    """
+    lo, hi = np.inf, -np.inf
+    for i in range(0, img.shape[0], rows):
+        block = np.asarray(img[i:i+rows])
+        lo, hi = min(lo, float(block.min())), max(hi, float(block.max()))
+    if hi == lo:
+        hi = lo + 1
+    counts = np.zeros(bins, dtype=np.int64)
+    for i in range(0, img.shape[0], rows):
+        block = np.asarray(img[i:i+rows], dtype=np.float64)
+        inds = np.minimum(((block - lo) * (bins / (hi - lo))).astype(np.int64), bins - 1)
+        counts += np.bincount(inds.ravel(), minlength=bins)
+    return counts, lo, hi
+
+def histogram(path, cp=catalog.catalog_params):
+    "(counts, lo, hi) of the tif at path, from the catalog if it's up to date, else computed and stored"
+    key = catalog.normpath(path)
+    mtime = os.path.getmtime(path)
+    con = catalog.connect(cp['db'])
+    row = con.execute("SELECT mtime, lo, hi, counts FROM histograms WHERE path = ?", (key,)).fetchone()
+    if row and row[0] == mtime:
+        con.close()
+        return np.frombuffer(row[3], dtype=np.int64), row[1], row[2]
+    counts, lo, hi = streaming_histogram(tiffio.imread_lazy(path))
+    con.execute("INSERT OR REPLACE INTO histograms VALUES (?, ?, ?, ?, ?)", (key, mtime, lo, hi, counts.tobytes()))
+    con.commit()
+    con.close()
+    return counts, lo, hi
+
+def percentiles(counts, lo, hi, qs):
+    "the percentiles qs (0-100) of the histogrammed values"
+    cdf = np.concatenate([[0], np.cumsum(counts)]) / counts.sum()
+    edges = np.linspace(lo, hi, len(counts) + 1)
+    return np.interp(np.asarray(qs) / 100, cdf, edges)
+
+def mode(counts, lo, hi):
+    "the center of the fullest bin"
+    width = (hi - lo) / len(counts)
+    return lo + (np.argmax(counts) + 0.5) * width
+
+def image_norm(path, kind='percentile', p_lo=1, p_hi=99, cp=catalog.catalog_params):
+    """
+    The normalization of the whole image at path, as keyword args for unet.normalize_X:
+    kind='percentile': p_lo -> 0 and p_hi -> 1.
+    kind='mode': the histogram mode -> 0.5, with the contrast of the percentile range, so the
+                 modes (the background) of all our images line up.
+    """
+    counts, lo, hi = histogram(path, cp)
+    a, b = percentiles(counts, lo, hi, [p_lo, p_hi])
+    if kind == 'percentile':
+        return {'mode' : 'percentile', 'lo' : a, 'hi' : b}
+    if kind == 'mode':
+        return {'mode' : 'mode', 'lo' : a, 'hi' : b, 'center' : mode(counts, lo, hi)}
+    raise ValueError("unknown normalization: " + str(kind))
@@ -20,36 +20,180 @@ def sample_patches(data, patch_size, n_samples=100, verbose=False):
     res = np.stack([data[r[0] - patch_size[0] // 2:r[0] + patch_size[0] - patch_size[0] // 2, r[1] - patch_size[1] // 2:r[1] + patch_size[1] - patch_size[1] // 2] for r in zip(*rand_inds)])
     return res
 
+## boundary conditions. Instead of padding (or mirroring) the whole image we compute, for each patch,
+## the indices into the image that the boundary condition maps the patch pixels to. Patches inside
+## the image are plain views. Only patches which hang over an edge are gathered into a new array.
+
+boundary_modes = {
+    'mirror'    : 'symmetric', # the edge pixel is repeated: ... c b a | a b c ...
+    'symmetric' : 'symmetric',
+    'reflect'   : 'reflect',   # the edge pixel is not repeated: ... c b | a b c ...
+    'edge'      : 'edge',      # ... a a | a b c ...
+    'constant'  : 'constant',  # ... 0 0 | a b c ...
+}
+
+def boundary_indices(start, width, n, boundary_cond='mirror'):
+    """
+    Indices into an axis of length n for the pixels [start, start+width), which may lie outside [0, n).
+    Out-of-bounds pixels are mapped back into the axis according to boundary_cond.
+    For boundary_cond='constant' they are marked with -1.
+    """
+    before = max(0, -start)
+    after  = max(0, start + width - n)
+    idx = np.arange(n)
+    if before or after:
+        mode = boundary_modes[boundary_cond]
+        if mode == 'constant':
+            idx = np.pad(idx, (before, after), mode='constant', constant_values=-1)
+        else:
+            idx = np.pad(idx, (before, after), mode=mode)
+    return idx[start+before : start+before+width]
+
+def extract_patch(img, coord, shape, boundary_cond='mirror', cval=0):
+    """
+    The patch of `shape` (in array order) whose top left corner is at coord.
+    The coordinates may be negative or hang over the bottom and right edges of img.
+    Returns a view into img when the patch lies inside the image.
+    """
+    x, y = coord
+    dx, dy = shape
+    a, b = img.shape
+    if 0 <= x and x+dx <= a and 0 <= y and y+dy <= b:
+        return img[x:x+dx, y:y+dy]
+    if boundary_cond is None:
+        raise ValueError("patch at {} with shape {} is outside of img with shape {}".format(coord, shape, img.shape))
+    ix = boundary_indices(x, dx, a, boundary_cond)
+    iy = boundary_indices(y, dy, b, boundary_cond)
+    mx, my = ix >= 0, iy >= 0
+    if not (mx.any() and my.any()):
+        return np.full((dx, dy), cval, dtype=img.dtype)
+    ## read only the block of img we need (img may be memory-mapped or lazy), then gather from it
+    x0, y0 = ix[mx].min(), iy[my].min()
+    block = np.asarray(img[x0:ix.max()+1, y0:iy.max()+1])
+    if boundary_modes[boundary_cond] == 'constant':
+        patch = np.full((dx, dy), cval, dtype=img.dtype)
+        patch[np.ix_(mx, my)] = block[np.ix_(ix[mx]-x0, iy[my]-y0)]
+        return patch
+    return block[np.ix_(ix-x0, iy-y0)]
+
+def iter_patches(coords, img, shape, boundary_cond='mirror', cval=0):
+    "yield the patch for each coordinate. shape is in array order. patches inside the img are views."
+    for cord in coords:
+        yield extract_patch(img, cord, shape, boundary_cond, cval)
+
 ## get patches from an image given coordinates and patch shapes.
 
-def sample_patches_from_img(coords, img, shape, boundary_cond='mirror'):
+def sample_patches_from_img(coords, img, shape, boundary_cond='mirror', cval=0):
     """
-    TODO: enable boundary conditions on all sides of the img, not just bottom and right.
+    Stack of patches from img with top left corners at coords.
+    Coordinates may lie outside of the image on any side, see boundary_modes for the options.
+    boundary_cond=None requires every patch to lie inside the image.
     """
     y_width, x_width = shape
-    # assert coords[:,0].max() <= img.shape[0]-x_width
-    # assert coords[:,1].max() <= img.shape[1]-y_width
-    if boundary_cond=='mirror':
-        a,b = img.shape
-        img2 = np.zeros((2*a, 2*b), dtype=img.dtype)
-        img2[:a, :b] = img.copy()
-        img2[a:2*a, :b] = img[::-1,:].copy()
-        img2[:a,b:2*b] = img[:,::-1].copy()
-        img2[a:2*a, b:2*b] = img[::-1, ::-1].copy()
-        img = img2
     patches = np.zeros(shape=(coords.shape[0], x_width, y_width), dtype=img.dtype)
-    for m,ind in enumerate(coords):
-        patches[m] = img[ind[0]:ind[0]+x_width, ind[1]:ind[1]+y_width]
+    for m, patch in enumerate(iter_patches(coords, img, (x_width, y_width), boundary_cond, cval)):
+        patches[m] = patch
     return patches
 
+def iter_patch_batches(coords, img, shape, n_per_batch, boundary_cond='mirror', cval=0):
+    """
+    Like sample_patches_from_img, but yields (coords, patches) in batches of at most n_per_batch
+    patches, so we never hold all the patches of a big image in memory at once.
+    shape is in array order.
+    """
+    for i in range(0, coords.shape[0], n_per_batch):
+        cs = coords[i:i+n_per_batch]
+        yield cs, np.stack(list(iter_patches(cs, img, shape, boundary_cond, cval)))
+
 ## Different ways of sampling pixel coordinates from an image
 
-def random_patch_coords(img, n, shape):
+def random_patch_coords(img, n, shape, index=None):
+    """
+    n random top left corners of patches of shape which fit inside img.
+    With an index from weighted_coords_index, corners are drawn with probability proportional
+    to the weight (e.g. membrane pixel count) of the patch, at O(1) cost per draw.
+    """
+    if index is not None:
+        return weighted_patch_coords(index, n)
     y_width, x_width = shape
     xc = np.random.randint(img.shape[0]-x_width, size=n)
     yc = np.random.randint(img.shape[1]-y_width, size=n)
     return np.stack((xc, yc), axis=1)
 
+## membrane weighted sampling. The weight of a patch is the sum of a weight image (e.g. the membrane mask)
+## over the patch. We compute it for every patch with its corner on a coarse grid from an integral image of
+## the grid cell sums, then draw grid cells from an alias table and jitter the corner inside the cell.
+
+def block_sums(img, grid, rows=None, fn=None):
+    """
+    sums of img (or of fn(img), e.g. the membrane mask of a label image) over grid x grid blocks
+    (the ragged last blocks included), shape ceil(a/grid), ceil(b/grid).
+    Reads img a band of rows at a time, so img can be a memmap much bigger than RAM.
+    """
+    a, b = img.shape
+    rows = rows or grid * max(1, 2**22 // (grid * b))
+    out = np.zeros((-(-a//grid), -(-b//grid)), dtype=np.float64)
+    cols = np.arange(0, b, grid)
+    for i in range(0, a, rows):
+        band = np.asarray(img[i:i+rows])
+        band = (fn(band) if fn else band).astype(np.float64)
+        band = np.add.reduceat(band, cols, axis=1)
+        out[i//grid : i//grid + -(-band.shape[0]//grid)] = np.add.reduceat(band, np.arange(0, band.shape[0], grid), axis=0)
+    return out
+
+def window_sums(cells, window):
+    "sums over every window x window block of cells (shape (a, b)), via an integral image"
+    a, b = window
+    integral = np.zeros((cells.shape[0]+1, cells.shape[1]+1))
+    integral[1:, 1:] = cells.cumsum(0).cumsum(1)
+    return integral[a:, b:] - integral[:-a, b:] - integral[a:, :-b] + integral[:-a, :-b]
+
+def alias_table(p):
+    "Vose's alias method: (prob, alias) for drawing index i with probability p[i] in O(1)"
+    n = len(p)
+    scaled = np.asarray(p, dtype=np.float64) * n / np.sum(p)
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = [i for i in range(n) if scaled[i] < 1]
+    large = [i for i in range(n) if scaled[i] >= 1]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1 - scaled[s]
+        (small if scaled[l] < 1 else large).append(l)
+    return prob, alias
+
+def alias_draw(prob, alias, n):
+    i = np.random.randint(len(prob), size=n)
+    return np.where(np.random.rand(n) < prob[i], i, alias[i])
+
+def weighted_coords_index(weight_img, shape, grid=16, floor=1., fn=None):
+    """
+    Precompute (once per image) what random_patch_coords needs to draw patches of shape (array order)
+    with probability proportional to the sum of weight_img (or fn(weight_img)) over the patch, plus floor
+    so that patches without membrane are still drawn now and then.
+    Patch corners are resolved to grid pixels: the weight of a corner is the weight of the patch
+    at the grid-aligned corner below it.
+    """
+    a, b = weight_img.shape
+    cells = block_sums(weight_img, grid, fn=fn)
+    w = window_sums(cells, (shape[0]//grid, shape[1]//grid))
+    ## only corners whose patch fits inside the image
+    na, nb = (a - shape[0])//grid + 1, (b - shape[1])//grid + 1
+    w = w[:na, :nb] + floor
+    prob, alias = alias_table(w.ravel())
+    return {'prob' : prob, 'alias' : alias, 'n_cols' : nb, 'grid' : grid,
+            'max_corner' : (a - shape[0], b - shape[1]), 'total' : w.sum()}
+
+def weighted_patch_coords(index, n):
+    "n random patch corners drawn from an index made by weighted_coords_index"
+    cells = alias_draw(index['prob'], index['alias'], n)
+    g = index['grid']
+    coords = np.stack(divmod(cells, index['n_cols']), axis=1) * g
+    coords += np.random.randint(g, size=coords.shape)
+    return np.minimum(coords, index['max_corner'])
+
 ## deprecated because we don't want coordinates to depend on patchshape
 @DeprecationWarning
 def regular_patch_coords(img, patchshape, step):
@@ -60,8 +204,17 @@ def regular_patch_coords(img, patchshape, step):
             coords.append((y,x))
     return np.array(coords)
 
-def square_grid_coords(img, step):
-    a,b = img.shape
+def square_grid_coords(img, step, offset=0):
+    """
+    top left corners of a square grid with spacing step covering img.
+    offset shifts the grid up and left, e.g. by the width of the patch border which will be thrown away,
+    so the valid part of the first patch starts at the image edge.
+    """
+    return grid_coords(img.shape, step, offset)
+
+def grid_coords(shape, step, offset=0):
+    "square_grid_coords for an image of shape"
+    a,b = shape
     a2,ar = divmod(a, step)
     b2,br = divmod(b, step)
     a2 += 1
@@ -70,56 +223,109 @@ def square_grid_coords(img, step):
     ind *= step
     ind = np.reshape(ind, (2, a2*b2))
     ind = np.transpose(ind)
+    ind -= offset
     return ind
 
 ## piece together a single image from a list of coordinates and patches
 
-def piece_together(patches, coords, imgshape=None, border=0):
+def weight_window(shape, border=0, kind='hard'):
+    """
+    2D float32 weights used to blend a patch of `shape` into the image.
+    The outer `border` pixels of the patch (boundary effects) always get weight 0.
+    kind = 'hard'     : weight 1 everywhere else, i.e. a simple average over patches.
+           'cosine'   : raised cosine, falling smoothly towards the border.
+           'gaussian' : gaussian centered on the patch with sigma = 1/4 of the valid width.
+    """
+    def window1d(n):
+        w = np.zeros(n, dtype=np.float32)
+        m = n - 2*border
+        if m <= 0:
+            return w
+        t = np.arange(m) + 0.5
+        if kind == 'hard':
+            v = np.ones(m)
+        elif kind == 'cosine':
+            v = np.sin(np.pi*t/m)**2
+        elif kind == 'gaussian':
+            v = np.exp(-0.5*((t - m/2)/(m/4))**2)
+        else:
+            raise ValueError("unknown window kind: {}".format(kind))
+        w[border:border+m] = v
+        return w
+    wx = window1d(shape[0])
+    wy = window1d(shape[1])
+    return wx[:,np.newaxis] * wy[np.newaxis,:]
+
+def add_patches(patches, coords, out, weight_sum, window):
+    """
+    Accumulate window-weighted patches into the preallocated `out` and the 2D `weight_sum` (in place).
+    patches.shape = (sample, x, y, channel) or (sample, x, y) matching the dims of out.
+    window is a 2D weight array with the patch shape (see weight_window).
+    Patches which hang over the edge of out are clipped, so out can have the shape
+    of the original image. Call finish_patches(out, weight_sum) when all the patches are in.
+    """
+    dx, dy = patches.shape[1:3]
+    a, b = out.shape[:2]
+    wpatch = window if patches.ndim == 3 else window[:,:,np.newaxis]
+
+    for cord, patch in zip(coords, patches):
+        x,y = cord
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x+dx, a), min(y+dy, b)
+        if x1 <= x0 or y1 <= y0:
+            continue
+        sx, sy = slice(x0-x, x1-x), slice(y0-y, y1-y)
+        out[x0:x1, y0:y1] += patch[sx, sy]*wpatch[sx, sy]
+        weight_sum[x0:x1, y0:y1] += window[sx, sy]
+
+def finish_patches(out, weight_sum):
+    """
+    Normalize the accumulated `out` by `weight_sum` in place.
+    Pixels no patch contributed to become nan.
+    """
+    w = weight_sum if out.ndim == 2 else weight_sum[:,:,np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        np.divide(out, w, out=out)
+    return out
+
+def piece_together(patches, coords, imgshape=None, border=0, window='hard', out=None):
     """
     patches must all be same shape!
     patches.shape = (sample, x, y, channel) or (sample, x, y)
     coords.shape = (sample, 2)
+    window is one of the kinds in weight_window, or a 2D weight array.
+    If out is given the result is written into it in place (out must start zeroed),
+    otherwise we allocate a result of shape (x, y, channel), float32 or float64 if the patches are.
+    Every call normalizes its result. To accumulate patches over several calls use add_patches
+    and run finish_patches once at the end.
     TODO: potentially add more ways of recombining than a simple average, i.e. maximum, etc
     """
 
     if patches.ndim == 3:
         patches = patches[:,:,:,np.newaxis]
     n_samp, dx, dy, channels = patches.shape
-    
-    x_size = coords[:,0].max() + dx
-    y_size = coords[:,1].max() + dy
-    if imgshape:
-        x_host, y_host = imgshape
-        x_size, y_size = max(x_size, x_host), max(y_size, y_host)
-    patch_img = np.zeros(shape=(x_size, y_size,channels))
-    count_img = np.zeros(shape=(x_size, y_size,channels))
-
-    # ignore parts of the image with boundary effects
-    mask = np.ones((dx, dy, channels))
-    if border>0:
-        mask[:,0:border] = 0
-        mask[:,-border:] = 0
-        mask[0:border,:] = 0
-        mask[-border:,:] = 0
 
-    for cord, patch in zip(coords, patches):
-        x,y = cord
-        patch_img[x:x+dx, y:y+dy] += patch*mask
-        count_img[x:x+dx, y:y+dy] += np.ones_like(patch)*mask
+    if out is None:
+        x_size = coords[:,0].max() + dx
+        y_size = coords[:,1].max() + dy
+        if imgshape:
+            x_host, y_host = imgshape
+            x_size, y_size = max(x_size, x_host), max(y_size, y_host)
+        out = np.zeros(shape=(x_size, y_size, channels), dtype=np.result_type(patches.dtype, np.float32))
+    if out.ndim == 2:
+        patches = patches[...,0]
+    weight_sum = np.zeros(out.shape[:2], dtype=np.float32)
+    if isinstance(window, str):
+        window = weight_window((dx, dy), border, window)
 
-    # if imgshape:
-    #     a,b = imgshape
-    #     patch_img = patch_img[:a,:b]
-    #     count_img = count_img[:a,:b]
-    
-    res = patch_img/count_img
+    add_patches(patches, coords, out, weight_sum, window)
+    res = finish_patches(out, weight_sum)
     if imgshape:
         a,b = imgshape
         res = res[:a, :b]
     return res
 
 
-
     # # x_size = coords[:,0].max() + dx
     # # y_size = coords[:,1].max() + dy
     # if imgshape:
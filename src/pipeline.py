@@ -0,0 +1,118 @@
+doc="""
+A small threaded pipeline: stages connected by bounded queues, with per-stage throughput stats
+so we can see which stage is the bottleneck.
+"""
+
+import threading
+import queue
+import time
+import traceback
+
+_done = object()
+
+class Stage(object):
+    """
+    `work(item, emit)` is called on every item that reaches the stage and may call `emit(x)` any number
+    of times to pass x on to the next stage. `flush(emit)` (optional) is called once after the input is
+    exhausted, for stages which buffer items. n_threads > 1 only makes sense for stateless work.
+    """
+    def __init__(self, name, work, n_threads=1, flush=None):
+        self.name = name
+        self.work = work
+        self.n_threads = n_threads
+        self.flush = flush
+        self.count = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.lock = threading.Lock()
+
+    def stats(self, wall):
+        busy = self.busy - self.blocked
+        return {'stage' : self.name,
+                'items' : self.count,
+                'errors' : self.errors,
+                'busy_s' : busy,
+                'blocked_s' : self.blocked,
+                'items_per_s' : self.count / busy if busy > 0 else float('nan'),
+                'utilization' : busy / (wall * self.n_threads) if wall > 0 else float('nan'),
+                }
+
+def _run_stage(stage, inq, outq, n_next):
+    def emit(x):
+        if outq is None:
+            return
+        t = time.time()
+        outq.put(x)
+        with stage.lock:
+            stage.blocked += time.time() - t
+
+    def worker():
+        while True:
+            item = inq.get()
+            if item is _done:
+                return
+            t = time.time()
+            try:
+                stage.work(item, emit)
+            except Exception:
+                traceback.print_exc()
+                with stage.lock:
+                    stage.errors += 1
+            with stage.lock:
+                stage.count += 1
+                stage.busy += time.time() - t
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(stage.n_threads)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    if stage.flush:
+        t = time.time()
+        try:
+            stage.flush(emit)
+        except Exception:
+            traceback.print_exc()
+            stage.errors += 1
+        stage.busy += time.time() - t
+    if outq is not None:
+        for _ in range(n_next):
+            outq.put(_done)
+
+def run_pipeline(items, stages, queue_size=4, verbose=True):
+    """
+    Push every item in `items` through the stages, in order.
+    The queues between stages hold at most queue_size items, which bounds the memory in flight.
+    An exception in a stage is printed and counted, it doesn't stop the pipeline.
+    Returns a list with one stats dict per stage.
+    """
+    queues = [queue.Queue(queue_size) for _ in stages] + [None]
+    runners = []
+    for i, stage in enumerate(stages):
+        n_next = stages[i+1].n_threads if i+1 < len(stages) else 0
+        th = threading.Thread(target=_run_stage, args=(stage, queues[i], queues[i+1], n_next), daemon=True)
+        th.start()
+        runners.append(th)
+
+    start = time.time()
+    for item in items:
+        queues[0].put(item)
+    for _ in range(stages[0].n_threads):
+        queues[0].put(_done)
+    for th in runners:
+        th.join()
+    wall = time.time() - start
+
+    stats = [s.stats(wall) for s in stages]
+    if verbose:
+        print_stats(stats, wall)
+    return stats
+
+def print_stats(stats, wall):
+    print("PIPELINE FINISHED IN {:.1f}s".format(wall))
+    print("{:<12}{:>8}{:>8}{:>10}{:>12}{:>12}{:>8}".format('stage', 'items', 'errors', 'busy_s', 'blocked_s', 'items/s', 'util'))
+    for s in stats:
+        print("{stage:<12}{items:>8}{errors:>8}{busy_s:>10.1f}{blocked_s:>12.1f}{items_per_s:>12.2f}{utilization:>8.0%}".format(**s))
+    bottleneck = max(stats, key=lambda s: s['utilization'])
+    print("Bottleneck:", bottleneck['stage'])
@@ -15,6 +15,10 @@ import unet
 import datasets
 import patchmaker
 import train
+import tiffio
+import pipeline
+import model_registry
+import normstats
 
 rationale = """
 Test out predict.py refactor.
@@ -25,27 +29,58 @@ predict_params = {
  'grey_tif_folder' : "data3/labeled_data_membranes/images_big/smaller2x/", # None,
  'batch_size' : 1,
  'width': 1024,
+ ## upper bound on the memory used by the tiles in flight (input + prediction), in MB
+ 'memory_budget_mb' : 1024,
+ ## how overlapping tiles are blended: 'hard' | 'cosine' | 'gaussian' (see patchmaker.weight_window)
+ 'blend' : 'hard',
+ ## test-time augmentation: average over this many dihedral variants of every tile, 1 | 2 | 4 | 8 (see dihedral_variants)
+ 'tta' : 1,
+ ## pick the tiling per image with plan_inference instead of using the fixed width and step
+ 'auto_tile' : False,
+ ## budget for the unet activations of one model.predict batch, in MB (see unet.activation_bytes)
+ 'activation_budget_mb' : 4096,
+ ## folder mode (predict_folder): number of reader and writer threads, queue length between stages and tif compression
+ 'n_readers' : 2,
+ 'n_writers' : 2,
+ 'queue_size' : 4,
+ 'compress' : 1,
+ ## tile normalization: 'patchwise' (min/max of each tile) or 'percentile' | 'mode' of the whole image (see normstats)
+ 'norm' : 'patchwise',
 }
 
+def min_border(itd, n_pool):
+    "the smallest tile border that is a multiple of 2**n_pool and at least as big as itd"
+    mpgrid = 2**n_pool
+    m,rm = divmod(itd, mpgrid)
+    return (m+1)*mpgrid
+
 def get_model_params_from_dir(predict_params, direc):
     pp = predict_params
     train_params = json.load(open(direc + '/train_params.json'))
     for key in ['n_convolutions_first_layer', 'n_pool', 'n_classes', 'dropout_fraction', 'itd', 'stakk', 'n_patches', 'split']:
         pp[key] = train_params.get(key, 'MISSING')
-    mpgrid = 2**pp['n_pool']
-    m,rm = divmod(pp['itd'], mpgrid)
-    border = (m+1)*mpgrid   # at least as big as itd.
-    pp['step'] = pp['width']-2*border
+    pp['border'] = min_border(pp['itd'], pp['n_pool'])
+    ## tile geometry measured by autotune.py for this model
+    if os.path.exists(direc + '/predict_params.json'):
+        tuned = json.load(open(direc + '/predict_params.json'))
+        for key in ['width', 'border', 'batch_size']:
+            pp[key] = tuned[key]
+    pp['step'] = pp['width']-2*pp['border']
     pp['initial_model_params'] = direc + '/unet_model_weights_checkpoint.h5'
     return pp
 
+def load_model_from_dir(direc, pp=None):
+    "returns the predict params and the (cached, see model_registry) model from a training directory"
+    pp = get_model_params_from_dir(dict(pp or predict_params), direc)
+    return pp, model_registry.get_model(pp)
+
 def predict_all(predict_parms, data=None, history=None):
     """
     history is modified in place!
     full images is either None or the name of a folder containing greyscale images.
     """
     pp = predict_params
-    model = train.get_model(predict_parms)
+    model = model_registry.get_model(predict_parms)
     print(model.summary())
 
     if data:
@@ -55,13 +90,8 @@ def predict_all(predict_parms, data=None, history=None):
     if pp['grey_tif_folder']:
         full_image_names = util.sglob(pp['grey_tif_folder'] + '*.tif')
         for name in full_image_names[:5]:
-            img = io.imread(name)
-            print(name, img.shape)
-            res = predict_single_image(model, img, pp)
-            print("Res shape", res.shape)
-            combo = np.stack((img, res), axis=0)
             path, base, ext =  util.path_base_ext(name)
-            io.imsave(pp['savedir'] + "/" + base + '_predict_' + ext, combo.astype('float32'))
+            predict_tif(model, name, pp['savedir'] + "/" + base + '_predict_' + ext, pp)
 
     def get_predictions_and_scores(X, Y):
         ypred = model.predict(unet.add_singleton_dim(X), pp['batch_size'])
@@ -89,7 +119,8 @@ def predict_all(predict_parms, data=None, history=None):
     if data or ('stakk' in pp):
         fig = plt.figure()
         if data:
-            plot_and_save(X_train, Y_train, fig, 'train')
+            if X_train is not None:
+                plot_and_save(X_train, Y_train, fig, 'train')
             plot_and_save(X_vali, Y_vali, fig, 'vali')
         if 'stakk' in pp: 
             pp['n_patches'] = -1  # all the data
@@ -99,33 +130,326 @@ def predict_all(predict_parms, data=None, history=None):
         plt.legend()
         plt.savefig(pp['savedir'] + '/acc_ce_dist.pdf')
 
-def predict_single_image(model, img, pp):
-    "unet predict on a greyscale img"
+def tiles_per_batch(pp, extra=0, tile_shape=None):
+    """
+    The number of tiles we can push through the model at once without the tiles in flight
+    (raw input, normalized input and the n_classes prediction, all float32, for each of the
+    pp['tta'] augmented variants, plus `extra` float32 values per pixel) exceeding pp['memory_budget_mb'].
+    Always at least one tile, and a multiple of batch_size when possible.
+    """
+    a, b = tile_shape or (pp['width'], pp['width'])
+    bytes_per_tile = a*b*4*((2 + pp['n_classes']) * pp.get('tta', 1) + extra)
+    n = int(pp.get('memory_budget_mb', 1024) * 2**20 // bytes_per_tile)
+    bs = pp['batch_size']
+    if n >= bs:
+        n -= n % bs
+    return max(n, 1)
 
-    coords = patchmaker.square_grid_coords(img, pp['step'])
-    w = pp['width']
-    X = patchmaker.sample_patches_from_img(coords, img, (w,w))
-    # a,b = img.shape
-    # n = pp['n_pool']
-    # am = a%(2**n)
-    # bm = b%(2**n)
-    # X = img[np.newaxis, :-am, :-bm]
-    X = unet.normalize_X(X)
-    X = unet.add_singleton_dim(X)
-    Y_pred = model.predict(X, batch_size=pp['batch_size'])
+## (number of 90 degree rotations, flip) for each of the 8 symmetries of the square.
+## The first 1, 2 and 4 variants don't change the tile shape.
+dihedral_variants = [(0, False), (0, True), (2, False), (2, True), (1, False), (1, True), (3, False), (3, True)]
+
+def dihedral(X, k, flip):
+    "flip (left-right) then rotate a stack of tiles by k*90 degrees"
+    if flip:
+        X = X[:, :, ::-1]
+    return np.rot90(X, k, axes=(1,2))
+
+def undo_dihedral(X, k, flip):
+    X = np.rot90(X, -k, axes=(1,2))
+    if flip:
+        X = X[:, :, ::-1]
+    return X
 
+def predict_tiles(model, X, pp, normalize=True):
+    """
+    unet predict on a stack of greyscale tiles. returns the membrane probability of each tile.
+    normalize: True for the default unet.normalize_X, or a dict of its keyword args (see image_norm), or False.
+    With pp['tta'] > 1 every tile is also predicted in that many flipped / rotated variants.
+    All variants with the same shape go through a single model.predict call, then the
+    transforms are undone and the variants averaged.
+    """
+    if normalize is True:
+        X = unet.normalize_X(X)
+    elif normalize:
+        X = unet.normalize_X(X, **normalize)
+    variants = dihedral_variants[:pp.get('tta', 1)]
+    if len(variants) == 1:
+        return _predict(model, X, pp)
+
+    n = X.shape[0]
+    res = np.zeros(X.shape, dtype=np.float32)
+    ## rotating by 90 degrees changes the shape of non-square tiles, so group variants by shape.
+    groups = {}
+    for k, flip in variants:
+        groups.setdefault(k % 2 == 1 and X.shape[1] != X.shape[2], []).append((k, flip))
+    for group in groups.values():
+        XX = np.concatenate([dihedral(X, k, flip) for k, flip in group])
+        Y_pred = _predict(model, XX, pp)
+        for i, (k, flip) in enumerate(group):
+            res += undo_dihedral(Y_pred[i*n:(i+1)*n], k, flip)
+    res /= len(variants)
+    return res
+
+def _predict(model, X, pp):
+    Y_pred = model.predict(unet.add_singleton_dim(X), batch_size=pp['batch_size'])
     if Y_pred.ndim == 3:
         print("NDIM 3, ")
-        Y_pred = Y_pred.reshape((-1, pp['width'], pp['width'], pp['n_classes']))
+        Y_pred = Y_pred.reshape(X.shape + (pp['n_classes'],))
+    return Y_pred[...,1]
+
+def predict_tif(model, name, savename, pp):
+    """
+    Predict on the greyscale tif `name` and save the float32 (greyscale, prediction) pair to `savename`.
+    The input is read lazily and the output is a memory-mapped tif which the prediction tiles are
+    blended into directly, so neither has to fit in RAM. 3D stacks are predicted plane by plane
+    and saved with shape (z, 2, y, x).
+    """
+    img = tiffio.imread_lazy(name)
+    print(name, img.shape)
+    norm = image_norm(name, pp)
+    if img.ndim == 2:
+        out = tiffio.create_memmap(savename, (2,) + img.shape, 'float32')
+        tiffio.copy_rows(img, out[0])
+        predict_single_image(model, img, pp, out=out[1], norm=norm)
+    else:
+        out = tiffio.create_memmap(savename, (img.shape[0], 2) + img.shape[1:], 'float32')
+        for z in range(img.shape[0]):
+            tiffio.copy_rows(img[z], out[z,0])
+            predict_single_image(model, img[z], pp, out=out[z,1], norm=norm)
+    out.flush()
+    del out
+
+def image_norm(name, pp):
+    "how to normalize the tiles of the image file name: True (per tile) or normstats.image_norm for pp['norm']"
+    if pp.get('norm', 'patchwise') == 'patchwise':
+        return True
+    return normstats.image_norm(name, pp['norm'])
+
+def predict_single_image(model, img, pp, out=None, norm=True):
+    """
+    unet predict on a greyscale img.
+    Tiles are streamed through the model in batches of `tiles_per_batch(pp)` and each batch of
+    predictions is added straight into a preallocated result, so peak memory is bounded by
+    pp['memory_budget_mb'] (plus the result itself) instead of growing with the image size.
+    img may be any lazily sliceable 2D array (see tiffio.imread_lazy).
+    If out is given (e.g. a memory-mapped tif) the result is accumulated there in place.
+    norm is passed on to predict_tiles as normalize.
+    """
+    return stitch_tiles(img, pp, lambda X: predict_tiles(model, X, pp, normalize=norm), out=out)
+
+def stitch_tiles(img, pp, predict_fn, out=None, channels=None, extra=0):
+    """
+    The tile engine behind predict_single_image.
+    predict_fn maps a stack of raw tiles (n, x, y) to predictions (n, x, y), or (n, x, y, channels)
+    in which case the result (or out) has shape img.shape + (channels,).
+    extra is the number of additional float32 values per tile pixel predict_fn holds (see tiles_per_batch).
+    The tiling comes from plan_inference if pp['auto_tile'], else from the fixed pp['width'] and pp['step'].
+    """
+    plan = plan_inference(img.shape, pp) if pp.get('auto_tile') else grid_plan(img.shape, pp)
+    print("{mode} plan: {n_tiles} tile(s) of {tile_shape}, {wasted:.1%} of the compute wasted on overlap and padding".format(**plan))
+    tile_shape = plan['tile_shape']
+    window = patchmaker.weight_window(tile_shape, pp['itd'], pp.get('blend', 'hard'))
+    if out is None:
+        shape = img.shape if channels is None else img.shape + (channels,)
+        res = np.zeros(shape, dtype=np.float32)
+        weight_sum = np.zeros(img.shape, dtype=np.float32)
+    else:
+        res = out
+        res[...] = 0
+        weight_sum = tiffio.scratch_memmap(img.shape, 'float32')
+    n_per_batch = tiles_per_batch(pp, extra, tile_shape)
+    for cs, X in patchmaker.iter_patch_batches(plan['coords'], img, tile_shape, n_per_batch):
+        patchmaker.add_patches(predict_fn(X), cs, res, weight_sum, window)
+    return patchmaker.finish_patches(res, weight_sum)
+
+## inference planning
+
+def _plan(mode, imgshape, tile_shape, coords, pp):
+    computed = coords.shape[0] * tile_shape[0] * tile_shape[1]
+    return {'mode' : mode,
+            'tile_shape' : tuple(int(t) for t in tile_shape),
+            'coords' : coords,
+            'n_tiles' : coords.shape[0],
+            'wasted' : 1 - imgshape[0]*imgshape[1] / computed,
+            'activation_mb' : unet.activation_bytes(tile_shape, pp['n_pool'], pp['n_convolutions_first_layer'],
+                                                    pp['n_classes'], pp['batch_size']) / 2**20,
+            }
+
+def grid_plan(imgshape, pp):
+    "the fixed tiling: square tiles of pp['width'] on a grid with spacing pp['step']"
+    w = pp['width']
+    ## shift the grid by the border, so the image edges get mirrored context like everywhere else
+    coords = patchmaker.grid_coords(imgshape, pp['step'], offset=pp.get('border', 0))
+    return _plan('grid', imgshape, (w,w), coords, pp)
+
+def plan_inference(imgshape, pp):
+    """
+    Choose how to tile an image of imgshape so the unet activations of one model.predict batch
+    fit in pp['activation_budget_mb'] (estimated with unet.activation_bytes).
+    - If the whole image (plus pp['border'] of mirrored context on every side, padded up to a multiple
+      of 2**n_pool) fits, predict it as a single tile.
+    - Otherwise use square tiles with the smallest border (pp['border'] is the smallest multiple of
+      2**n_pool which is at least itd) and the largest width that fits, or a somewhat smaller width
+      if that wastes less on covering the image.
+    The returned plan also has the fraction of computed pixels wasted on overlap and padding.
+    """
+    g = 2**pp['n_pool']
+    border = pp['border']
+    budget = pp.get('activation_budget_mb', 4096) * 2**20
+    def fits(shape):
+        return unet.activation_bytes(shape, pp['n_pool'], pp['n_convolutions_first_layer'], pp['n_classes'], pp['batch_size']) <= budget
+    def roundup(n):
+        return -(-n // g) * g
+
+    whole = (roundup(imgshape[0] + 2*border), roundup(imgshape[1] + 2*border))
+    if fits(whole):
+        return _plan('whole', imgshape, whole, np.array([[-border, -border]]), pp)
+
+    w = roundup(max(whole))
+    while w > 2*border + g and not fits((w, w)):
+        w -= g
+    ## the largest tile isn't always the least wasteful once the grid has to cover the image,
+    ## so also try the next few smaller widths and keep the one computing the fewest pixels.
+    best = None
+    for width in range(w, max(w//2, 2*border), -g):
+        coords = patchmaker.grid_coords(imgshape, width - 2*border, offset=border)
+        plan = _plan('tiled', imgshape, (width, width), coords, pp)
+        if best is None or plan['wasted'] < best['wasted']:
+            best = plan
+    return best
+
+## ensembles
+
+ensemble_stats = ['mean', 'std', 'min', 'max']
+
+def predict_tiles_ensemble(models, X, pp, norm={}):
+    """
+    Predict a stack of tiles with every model in turn, keeping only running per-pixel statistics
+    (mean and variance updated incrementally with Welford's algorithm, plus min and max), so memory
+    doesn't grow with the size of the ensemble.
+    returns (n, x, y, 4) with the channels in the order of ensemble_stats. std is the population std, like np.std.
+    norm are the keyword args for unet.normalize_X (see image_norm).
+    """
+    X = unet.normalize_X(X, **norm)
+    mean = np.zeros(X.shape, dtype=np.float32)
+    m2   = np.zeros(X.shape, dtype=np.float32)
+    mn   = np.full(X.shape, np.inf, dtype=np.float32)
+    mx   = np.full(X.shape, -np.inf, dtype=np.float32)
+    for i, model in enumerate(models, 1):
+        y = predict_tiles(model, X, pp, normalize=False)
+        delta = y - mean
+        mean += delta / i
+        m2 += delta * (y - mean)
+        np.minimum(mn, y, out=mn)
+        np.maximum(mx, y, out=mx)
+    std = np.sqrt(m2 / len(models))
+    return np.stack([mean, std, mn, mx], axis=-1)
+
+def ensemble_params(dirs, pp=None):
+    """
+    Predict params which work for every model in dirs: the largest itd and border of the ensemble,
+    so every model sees the same tiles. Returns the params and the list of (cached) models.
+    """
+    params, models = zip(*[load_model_from_dir(d, pp) for d in dirs])
+    pp = dict(params[0])
+    pp['itd'] = max(p['itd'] for p in params)
+    pp['border'] = max(p['border'] for p in params)
+    pp['step'] = pp['width'] - 2*pp['border']
+    return pp, list(models)
+
+def predict_ensemble_tif(models, name, savename, pp):
+    """
+    Run the ensemble over the greyscale tif `name` in a single streaming pass and save a float32 tif
+    with channels (greyscale, mean, std, min, max) to `savename` (memory-mapped, like predict_tif).
+    """
+    img = tiffio.imread_lazy(name)
+    print(name, img.shape)
+    out = tiffio.create_memmap(savename, (1 + len(ensemble_stats),) + img.shape, 'float32')
+    tiffio.copy_rows(img, out[0])
+    norm = image_norm(name, pp)
+    norm = {} if norm is True else norm
+    stitch_tiles(img, pp, lambda X: predict_tiles_ensemble(models, X, pp, norm),
+                 out=np.moveaxis(out[1:], 0, -1), extra=2*len(ensemble_stats))
+    out.flush()
+    del out
+
+def predict_ensemble(dirs, names, savedir, pp=None):
+    "predict every greyscale tif in names with the ensemble of models in the training dirs. see predict_ensemble_tif."
+    pp, models = ensemble_params(dirs, pp)
+    for name in names:
+        path, base, ext =  util.path_base_ext(name)
+        predict_ensemble_tif(models, name, savedir + "/" + base + '_ensemble_' + ext, pp)
+
+def predict_folder(model, names, pp):
+    """
+    Predict on every greyscale tif in names and save the (greyscale, prediction) pairs to pp['savedir'].
+    Runs as a pipeline with bounded queues between the stages, so decoding, inference and compression overlap:
+    - pp['n_readers'] threads decode each image, cut it into tiles and normalize them.
+    - one inference thread batches tiles across images (`tiles_per_batch(pp)` at a time) and
+      blends the predictions into each image's result.
+    - pp['n_writers'] threads finish, compress and save the finished images.
+    Prints (and returns) the throughput of every stage.
+    """
+    w = pp['width']
+    n_batch = tiles_per_batch(pp)
+    window = patchmaker.weight_window((w,w), pp['itd'], pp.get('blend', 'hard'))
+
+    def read(name, emit):
+        img = io.imread(name)
+        norm = image_norm(name, pp)
+        norm = {} if norm is True else norm
+        coords = grid_plan(img.shape, pp)['coords']
+        job = {'name' : name,
+               'img' : img,
+               'res' : np.zeros(img.shape, dtype=np.float32),
+               'weight_sum' : np.zeros(img.shape, dtype=np.float32),
+               'n_left' : coords.shape[0],
+               }
+        for cs, X in patchmaker.iter_patch_batches(coords, img, (w,w), n_batch):
+            emit((job, cs, unet.normalize_X(X, **norm)))
+
+    pending = []
+    def run_batch(emit):
+        "predict the first n_batch pending tiles (they may come from several images)"
+        chunks, n = [], 0
+        while pending and n < n_batch:
+            job, cs, X = pending.pop(0)
+            k = min(n_batch - n, cs.shape[0])
+            if k < cs.shape[0]:
+                pending.insert(0, (job, cs[k:], X[k:]))
+            chunks.append((job, cs[:k], X[:k]))
+            n += k
+        Y_pred = predict_tiles(model, np.concatenate([X for _,_,X in chunks]), pp, normalize=False)
+        i = 0
+        for job, cs, _ in chunks:
+            k = cs.shape[0]
+            patchmaker.add_patches(Y_pred[i:i+k], cs, job['res'], job['weight_sum'], window)
+            i += k
+            job['n_left'] -= k
+            if job['n_left'] == 0:
+                emit(job)
+
+    def infer(chunk, emit):
+        pending.append(chunk)
+        while sum(c[1].shape[0] for c in pending) >= n_batch:
+            run_batch(emit)
+
+    def flush(emit):
+        while pending:
+            run_batch(emit)
 
-    Y_pred = Y_pred[...,1]
-    #Y_new = np.zeros((a,b))
-    #Y_new[:-am, :-bm] = Y_pred
-    #print("Y_pred shape: ", Y_pred.shape)
-    #io.imsave('Ypred.tif', Y_pred)
+    def write(job, emit):
+        res = patchmaker.finish_patches(job['res'], job['weight_sum'])
+        combo = np.stack((job['img'], res), axis=0).astype('float32')
+        path, base, ext =  util.path_base_ext(job['name'])
+        io.imsave(pp['savedir'] + "/" + base + '_predict_' + ext, combo, plugin='tifffile', compress=pp.get('compress', 1))
 
-    res = patchmaker.piece_together(Y_pred, coords, imgshape=img.shape, border=pp['itd'])
-    return res[...,0].astype(np.float32)
+    stages = [pipeline.Stage('read', read, n_threads=pp.get('n_readers', 2)),
+              pipeline.Stage('predict', infer, flush=flush),
+              pipeline.Stage('write', write, n_threads=pp.get('n_writers', 2)),
+              ]
+    return pipeline.run_pipeline(names, stages, queue_size=pp.get('queue_size', 4))
 
 def accuracy(ytrue, ypred):
     """compute accuracy, assume ytrue is labels, and ypred is dist-over-labels with an extra dim."""
@@ -150,5 +474,10 @@ if __name__ == '__main__':
     predict_params['n_patches'] = 120
     predict_params['split'] = 6
     predict_params['savedir'] = sys.argv[2]
-    predict_all(predict_params)
+    if len(sys.argv) > 3:
+        ## folder mode: python predict.py traindir savedir grey_tif_folder
+        model = model_registry.get_model(predict_params)
+        predict_folder(model, util.sglob(sys.argv[3] + '/*.tif'), predict_params)
+    else:
+        predict_all(predict_params)
 
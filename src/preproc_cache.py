@@ -0,0 +1,89 @@
+doc="""
+A disk cache for slow, deterministic preprocessing of whole images (e.g. equalize_adapthist).
+Results are keyed by the content hash of the input file, the name of the operation and its params,
+so renaming or re-saving an unchanged image still hits the cache, and editing an image misses it.
+They are stored as .npy files and returned memory-mapped. When the cache grows past max_mb the
+least recently used results are deleted.
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+import skimage.io as io
+
+import util
+
+cache_params = {
+ 'cachedir' : 'preproc_cache/',
+ 'max_mb' : 8192,
+}
+
+## file hashes by (path, size, mtime), so we hash each file at most once per process
+_hashes = {}
+
+def content_hash(fname):
+    st = os.stat(fname)
+    key = (os.path.abspath(fname), st.st_size, st.st_mtime)
+    if key not in _hashes:
+        _hashes[key] = util.file_hash(fname)
+    return _hashes[key]
+
+def cache_key(fname, op, params):
+    name = op.__module__ + '.' + op.__name__
+    desc = json.dumps([content_hash(fname), name, params], sort_keys=True)
+    return hashlib.sha1(desc.encode()).hexdigest()
+
+def cached(fname, op, cp=cache_params, **params):
+    """
+    op(io.imread(fname), **params), memory-mapped from the cache if we've computed it before.
+    params must be json serializable.
+    """
+    util.safe_makedirs(cp['cachedir'])
+    path = os.path.join(cp['cachedir'], cache_key(fname, op, params) + '.npy')
+    ## another process (e.g. a build_stakk worker) may evict the entry at any moment, then we recompute it
+    if os.path.exists(path):
+        try:
+            os.utime(path) # mark as recently used
+            return np.load(path, mmap_mode='r')
+        except FileNotFoundError:
+            pass
+    result = op(io.imread(fname), **params)
+    ## write to a temporary name first, so other processes never see a partial file
+    tmp = path + '.{}.tmp'.format(os.getpid())
+    with open(tmp, 'wb') as f:
+        np.save(f, result)
+    os.replace(tmp, path)
+    evict(cp, keep=path)
+    try:
+        return np.load(path, mmap_mode='r')
+    except FileNotFoundError:
+        return result
+
+def evict(cp=cache_params, keep=None):
+    """
+    delete least recently used results (except keep) until the cache is at most cp['max_mb'].
+    Other processes may be evicting at the same time, so entries can vanish under us.
+    """
+    entries = []
+    total = 0
+    for f in os.listdir(cp['cachedir']):
+        f = os.path.join(cp['cachedir'], f)
+        if not f.endswith('.npy'):
+            continue
+        try:
+            st = os.stat(f)
+        except FileNotFoundError:
+            continue
+        total += st.st_size
+        if f != keep:
+            entries.append((st.st_mtime, st.st_size, f))
+    entries.sort()
+    while entries and total > cp['max_mb'] * 2**20:
+        _, size, f = entries.pop(0)
+        total -= size
+        try:
+            os.remove(f)
+            print("Evicting cached: ", f)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,77 @@
+doc="""
+Build downscaled copies of image directories (the down2x / down3x / down6x folders) in a single pass:
+every image is read once and all the requested scales are written from it, images in parallel.
+Downscaling is a block reduction by reshaping: mean for greyscale images, max or mode for labels.
+"""
+
+import os
+import functools
+import multiprocessing
+import numpy as np
+import skimage.io as io
+
+import util
+
+def block_reduce(img, f, kind='mean'):
+    """
+    Reduce img (a, b) over f x f blocks, cropping the ragged bottom / right edge.
+    kind: 'mean' (float32), 'max' or 'mode' (the most common value in each block, for labels).
+    """
+    a, b = img.shape[0]//f, img.shape[1]//f
+    blocks = img[:a*f, :b*f].reshape(a, f, b, f)
+    if kind == 'mean':
+        return blocks.mean(axis=(1,3), dtype=np.float64).astype(np.float32)
+    if kind == 'max':
+        return blocks.max(axis=(1,3))
+    if kind == 'mode':
+        ## sort each block, the mode ends the longest run of equal values (ties go to the smallest value).
+        ## Memory doesn't grow with the number of labels, instance masks have hundreds.
+        s = np.sort(blocks.transpose(0,2,1,3).reshape(a*b, f*f), axis=1)
+        pos = np.arange(f*f)
+        starts = np.ones(s.shape, dtype=bool)
+        starts[:,1:] = s[:,1:] != s[:,:-1]
+        run = pos - np.maximum.accumulate(np.where(starts, pos, 0), axis=1)
+        return s[np.arange(a*b), np.argmax(run, axis=1)].reshape(a, b)
+    raise ValueError("unknown kind: " + str(kind))
+
+def pyramid(img, factors, kind='mean'):
+    """
+    {f : img downscaled by f} for every f in factors.
+    mean and max are computed from the largest already computed level whose factor divides f,
+    which gives the same result and is much cheaper. The mode of modes isn't the mode, so
+    modes are always computed from the full image.
+    """
+    levels = {1 : img}
+    for f in sorted(factors):
+        base = 1
+        if kind != 'mode':
+            base = max(g for g in levels if f % g == 0)
+        levels[f] = block_reduce(levels[base], f // base, kind)
+    del levels[1]
+    return levels
+
+def pyramid_image(fname, factors, kind='mean', normalize=False):
+    "write the pyramid of fname into the down{f}x subdirectories next to it"
+    path, base, ext = util.path_base_ext(fname)
+    img = io.imread(fname)
+    for f, lvl in pyramid(img, factors, kind).items():
+        if normalize:
+            lvl = lvl / lvl.max()
+        newpath = os.path.join(path, 'down{}x'.format(f))
+        util.safe_makedirs(newpath)
+        io.imsave(os.path.join(newpath, base + ext), lvl, compress=1)
+    return fname, img.shape
+
+def build_pyramid(imgdir, factors=(2,3,6), kind='mean', normalize=False, ext='.tif', n_procs=4):
+    """
+    Downscale every image in imgdir by every factor, into imgdir/down{f}x/.
+    Use kind='mean' for greyscale images and kind='max' or 'mode' for label images.
+    normalize divides each level by its max (like the old mean_downscale).
+    """
+    names = util.sglob(os.path.join(imgdir, '*' + ext))
+    work = functools.partial(pyramid_image, factors=factors, kind=kind, normalize=normalize)
+    pool = multiprocessing.Pool(n_procs)
+    for fname, shape in pool.imap_unordered(work, names):
+        print("Downscaled: ", fname, shape)
+    pool.close()
+    pool.join()
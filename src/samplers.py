@@ -0,0 +1,134 @@
+doc="""
+Choose which patches go into each training batch, by index, so an epoch never copies the training set.
+A sampler hands out one index array per batch; gather_batch copies just those patches into a
+preallocated buffer that is reused for every batch.
+"""
+
+import numpy as np
+
+import patchmaker
+import tiffio
+import normstats
+
+class SequentialSampler(object):
+    "batches in stack order, e.g. for validation or debugging"
+    def __init__(self, n, batch_size):
+        self.n = n
+        self.batch_size = batch_size
+        self.inds = np.arange(n)
+
+    def __len__(self):
+        return self.n // self.batch_size
+
+    def batch_indices(self, idx):
+        bs = self.batch_size
+        return self.inds[idx*bs:(idx+1)*bs]
+
+    def on_epoch_end(self):
+        pass
+
+class ShuffleSampler(SequentialSampler):
+    "every patch once per epoch, in a new random order every epoch"
+    def __init__(self, n, batch_size):
+        super(ShuffleSampler, self).__init__(n, batch_size)
+        np.random.shuffle(self.inds)
+
+    def on_epoch_end(self):
+        np.random.shuffle(self.inds)
+
+class WeightedSampler(SequentialSampler):
+    """
+    patches drawn with replacement, with probability proportional to weights,
+    e.g. the number of membrane pixels in each patch.
+    """
+    def __init__(self, weights, batch_size):
+        weights = np.asarray(weights, dtype=np.float64)
+        super(WeightedSampler, self).__init__(len(weights), batch_size)
+        self.p = weights / weights.sum()
+        self.on_epoch_end()
+
+    def on_epoch_end(self):
+        self.inds = np.random.choice(self.n, size=self.n, p=self.p)
+
+def membrane_weights(Y, floor=1):
+    "number of membrane (label 1) pixels per patch, plus floor so no patch is never drawn"
+    return (Y == 1).sum(axis=(1,2)) + floor
+
+def get_sampler(Y, train_params):
+    "the sampler named by train_params['sampler']: 'shuffle' (default), 'sequential' or 'weighted' (by membrane)"
+    kind = train_params.get('sampler', 'shuffle')
+    bs = train_params['batch_size']
+    if kind == 'shuffle':
+        return ShuffleSampler(Y.shape[0], bs)
+    elif kind == 'sequential':
+        return SequentialSampler(Y.shape[0], bs)
+    elif kind == 'weighted':
+        return WeightedSampler(membrane_weights(Y), bs)
+    raise ValueError("unknown sampler: " + str(kind))
+
+def batch_buffer(X, batch_size):
+    "an empty buffer for batches of batch_size patches from X"
+    return np.empty((batch_size,) + X.shape[1:], dtype=X.dtype)
+
+def gather_batch(X, inds, out=None):
+    """
+    X[inds] written into out (see batch_buffer) instead of a new array.
+    Works for memmapped X, where the indices are read in sorted order to keep the reads sequential.
+    """
+    if out is None:
+        out = batch_buffer(X, len(inds))
+    out = out[:len(inds)]
+    if isinstance(X, np.memmap):
+        for j in np.argsort(inds, kind='mergesort'):
+            out[j] = X[inds[j]]
+    else:
+        np.take(X, inds, axis=0, out=out)
+    return out
+
+class RandomPatchSource(object):
+    """
+    Patches cut on the fly at random places in full size images, instead of from a pre-cut stakk.
+    The images and labels are memory-mapped (tiffio.imread_lazy) and only the sampled patches are read.
+    Patches are drawn with probability proportional to their number of membrane pixels (see
+    patchmaker.weighted_coords_index), images with probability proportional to their total weight.
+    shape is the patch shape in array order. label_fn (e.g. train.fix_labels) is applied to every label patch.
+    With norm ('percentile' | 'mode', see normstats.image_norm) the grey patches are returned as float32,
+    normalized with the statistics of their whole image by normalize_fn (unet.normalize_X).
+    """
+    def __init__(self, grey_names, label_names, shape, grid=16, floor=1., membrane_labels=(1,), label_fn=None,
+                 norm=None, normalize_fn=None):
+        self.shape = tuple(shape)
+        self.label_fn = label_fn
+        self.normalize_fn = normalize_fn
+        self.norms = [normstats.image_norm(n, norm) for n in grey_names] if norm else None
+        self.greys = [tiffio.imread_lazy(n) for n in grey_names]
+        self.labels = [tiffio.imread_lazy(n) for n in label_names]
+        is_membrane = lambda lab: np.isin(lab, membrane_labels)
+        self.indexes = [patchmaker.weighted_coords_index(lab, self.shape, grid, floor, fn=is_membrane) for lab in self.labels]
+        totals = np.array([ind['total'] for ind in self.indexes])
+        self.p_img = totals / totals.sum()
+
+    def sample(self, n, out=None):
+        """
+        n random (grey, label) patch pairs as arrays (n, a, b).
+        out = (Xbuffer, Ybuffer) are filled instead of allocating new arrays.
+        """
+        if out is None:
+            out = (np.empty((n,) + self.shape, dtype=self.grey_dtype()),
+                   np.empty((n,) + self.shape, dtype=self.labels[0].dtype))
+        X, Y = out[0][:n], out[1][:n]
+        imgs = np.random.choice(len(self.greys), size=n, p=self.p_img)
+        for i in range(n):
+            k = imgs[i]
+            coord = patchmaker.random_patch_coords(None, 1, self.shape, self.indexes[k])[0]
+            X[i] = patchmaker.extract_patch(self.greys[k], coord, self.shape)
+            Y[i] = patchmaker.extract_patch(self.labels[k], coord, self.shape)
+        if self.norms:
+            for k in np.unique(imgs):
+                X[imgs == k] = self.normalize_fn(X[imgs == k], **self.norms[k])
+        if self.label_fn:
+            Y = self.label_fn(Y)
+        return X, Y
+
+    def grey_dtype(self):
+        return np.float32 if self.norms else self.greys[0].dtype
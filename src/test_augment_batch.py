@@ -0,0 +1,40 @@
+info = """
+test warping.randomly_augment_batch. The fused flip + warp + rotation must give the same labels as
+the original per-patch path (unet_warp_orig + ndimage.rotate), including at the corners rotated in
+from outside the patch.
+"""
+
+import numpy as np
+from scipy.ndimage import rotate
+
+import warping
+
+def make_labels(shape):
+	lab = np.zeros(shape, dtype='uint8')
+	lab[::16] = 1
+	lab[:, ::16] = 1
+	return lab
+
+def test1():
+	"""
+	Rotation only (no warp, no flip): fused labels vs unet_warp_orig + rotate.
+	"""
+	lab = make_labels((64, 64))
+	for angle in [-21.9, 10., 35.]:
+		ylab,_,_ = warping.unet_warp_orig(lab, np.zeros((2,3,3)), twolabel=True)
+		ref = rotate(ylab, angle, reshape=False) # as in randomly_augment_patches
+		coords = warping.compose_coords(warping.augmentation_transforms(lab.shape, False, angle, None))
+		D = warping.membrane_distance(lab[np.newaxis])
+		res = warping.resample_labels(D, coords[np.newaxis])[0]
+		print(angle, "membrane fraction (fused, orig):", res.mean(), ref.mean())
+		print(angle, "corners are background:", res[0,0]==0 and res[0,-1]==0 and res[-1,0]==0 and res[-1,-1]==0)
+		print(angle, "agreement:", (res == ref).mean())
+
+def test2():
+	"""
+	The whole batch with rotation turned on: rotated-in corners must not become membrane.
+	"""
+	Y = np.stack([make_labels((64, 64))]*8)
+	X = np.random.rand(*Y.shape).astype('float32')
+	Xa, Ya = warping.randomly_augment_batch(X, Y, False, True, 2, 30)
+	print("membrane fraction (augmented, original):", Ya.mean(), (Y==1).mean())
@@ -0,0 +1,26 @@
+info = """
+test catalog. The roles inferred from the paths of our actual data directories.
+"""
+
+import catalog
+
+roles = {
+	'data3/labeled_data_membranes/images_big/smaller2x/20150127_EVLvsInner01_slice11.tif' : 'grey',
+	'data3/labeled_data_membranes/labels_big/smaller2x/20150127_EVLvsInner01_slice11.tif' : 'label',
+	'data3/labeled_data_cellseg/greyscales/down3x/20150430_eif4g_dome07_slice9.tif' : 'grey',
+	'data3/labeled_data_cellseg/labels/20150430_eif4g_dome07_R3D_MASKS.tif' : 'label',
+	'data3/labeled_data_cellseg/labels/down3x/20150430_eif4g_dome07_R3D_MASKS.tif' : 'label',
+	'data/20150127_EVLvsInner01_slice11_seg.tif' : 'label',
+	'imgs/20150127_EVLvsInner01_slice11_predict_100.tif' : 'prediction',
+	'data/grayscale_1.tif' : 'grey',
+}
+
+def test1():
+	bad = {p : (catalog.infer_role(p), r) for p, r in roles.items() if catalog.infer_role(p) != r}
+	print("infer_role Test:", not bad)
+	for p, (got, want) in bad.items():
+		print(p, got, "!=", want)
+	return not bad
+
+if __name__ == '__main__':
+	test1()
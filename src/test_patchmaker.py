@@ -177,6 +177,61 @@ def test7():
 	# plt.figure(figsize=(20,14))
 	# plt.imshow((img4-img3))
 
+def test8():
+	"""
+	Every blending window must reproduce the image exactly (away from the nan border) when
+	the patches are cut straight from the image. Also accumulate in place into a 2D float32 output.
+	"""
+	img_shape = np.random.randint(300, 500, (2,))
+	patch_shape = (64, 64)
+	border = 10
+	step = 64 - 2*16
+	img, patches, coords = make_img_patches_coords(img_shape, patch_shape, step)
+	for kind in ['hard', 'cosine', 'gaussian']:
+		res = patchmaker.piece_together(patches, coords, imgshape=img.shape, border=border, window=kind)
+		res = res[:,:,0]
+		diff = np.abs(img - res)[border:, border:]
+		print(kind, "res Test:", np.nanmax(diff) < 1e-5, res.dtype)
+	out = np.zeros(img.shape, dtype=np.float32)
+	res = patchmaker.piece_together(patches, coords, imgshape=img.shape, border=border, out=out)
+	print("in place:", np.shares_memory(res, out), np.nanmax(np.abs(img - out)[border:, border:]) < 1e-5)
+
+
+def test9():
+	"""
+	Patches hanging over any edge of the image must match a fully padded image for every boundary mode,
+	and patches inside the image should be views, not copies.
+	"""
+	img = np.random.rand(*np.random.randint(100, 300, (2,)))
+	border = 20
+	coords = patchmaker.square_grid_coords(img, 40, offset=border)
+	## the last patches start border before the edge and reach patch - step + border past it
+	pad = 80 - 40 + border
+	for mode in ['mirror', 'reflect', 'symmetric', 'edge', 'constant']:
+		padded = np.pad(img, pad, mode=patchmaker.boundary_modes[mode])
+		ref = np.stack([padded[x+pad:x+pad+80, y+pad:y+pad+80] for x,y in coords])
+		patches = patchmaker.sample_patches_from_img(coords, img, (80, 80), boundary_cond=mode)
+		print(mode, "res Test:", np.array_equal(ref, patches))
+	patch = patchmaker.extract_patch(img, (10, 10), (50, 50))
+	print("view:", np.shares_memory(patch, img))
+
+def test10():
+	"""
+	Membrane weighted random patches: the integral image window sums must match brute force,
+	and patches without membrane should only be drawn at the (small) floor rate.
+	"""
+	lab = np.zeros((600, 800), dtype='uint8')
+	lab[300:340, 100:300] = 1
+	cells = patchmaker.block_sums(lab, 16)
+	sums = patchmaker.window_sums(cells, (8, 8))
+	print("window sums Test:", sums[15, 5] == lab[240:368, 80:208].sum())
+	index = patchmaker.weighted_coords_index(lab, (128, 128), grid=16, floor=0.01)
+	coords = patchmaker.random_patch_coords(lab, 2000, (128, 128), index=index)
+	hits = np.mean([lab[x:x+128, y:y+128].any() for x,y in coords])
+	print("in bounds:", coords.min() >= 0, np.all(coords.max(0) <= (600-128, 800-128)))
+	print("fraction with membrane (should be ~1):", hits)
+
+
 
 # if __name__ == '__main__':
 # 	test1()
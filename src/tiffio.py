@@ -0,0 +1,38 @@
+doc="""
+Lazy TIFF input and memory-mapped TIFF output, so we can tile through images that don't fit in RAM.
+"""
+
+import tempfile
+import numpy as np
+import tifffile
+
+def imread_lazy(fname):
+    """
+    Open a tif without decompressing the whole thing into RAM.
+    - uncompressed, contiguous tifs are memory-mapped directly.
+    - compressed / tiled tifs are opened through zarr (if installed), which decodes only the tiles we slice.
+    - otherwise they are decoded once into a temporary memory-mapped file.
+    The result supports basic slicing, e.g. img[x:x+w, y:y+w].
+    """
+    try:
+        return tifffile.memmap(fname, mode='r')
+    except ValueError:
+        pass
+    try:
+        import zarr
+    except ImportError:
+        return tifffile.imread(fname, out='memmap')
+    return zarr.open(tifffile.imread(fname, aszarr=True), mode='r')
+
+def create_memmap(fname, shape, dtype='float32'):
+    "create an uncompressed tif of shape and dtype and return it memory-mapped for writing."
+    return tifffile.memmap(fname, shape=shape, dtype=dtype)
+
+def scratch_memmap(shape, dtype='float32'):
+    "a zeroed, memory-mapped array backed by an anonymous temporary file."
+    return np.memmap(tempfile.TemporaryFile(), mode='w+', shape=shape, dtype=dtype)
+
+def copy_rows(src, dst, rows=512):
+    "copy src into dst (same shape) a block of rows at a time, casting to dst.dtype."
+    for i in range(0, src.shape[0], rows):
+        dst[i:i+rows] = np.asarray(src[i:i+rows])
@@ -18,6 +18,8 @@ import predict
 
 from scipy.ndimage import zoom
 import patchmaker
+import samplers
+import chunkstore
 import skimage.io as io
 
 rationale = """
@@ -36,6 +38,9 @@ train_params = {
  'stakk'  : 'stakk_mem_2xdown_256.tif',
  #'stakk'  : 'stakk_mem_256_imgnorm.tif',
  #'stakk'  : 'stakk_mem_256_adapthist.tif',
+ ## 'patchwise' : min/max of each (augmented) patch
+ ## 'percentile' | 'mode' : p1/p99 (and p50 as the center for 'mode') of each patch from the stakk stats,
+ ##     or of each whole image (see normstats) with random_patches. Applied once, at load time.
  'norm' : 'patchwise',
 
  'n_patches' : 960,
@@ -46,6 +51,11 @@ train_params = {
  'epochs' : 900,
  'patience' : 30,
  'batches_per_epoch' : 'TBD',
+ ## processes building augmented batches in parallel, and how many batches they may prefetch
+ 'workers' : 4,
+ 'max_queue_size' : 10,
+ ## which patches make up each batch: 'shuffle' | 'sequential' | 'weighted' (by membrane pixels)
+ 'sampler' : 'shuffle',
 
  'optimizer' : 'adam', # 'sgd' or 'adam' (adam ignores momentum)
  'learning_rate' : 1.00e-5,
@@ -66,6 +76,17 @@ train_params = {
  'n_convolutions_first_layer' : 32,
  'dropout_fraction' : 0.10,
  'itd' : 24,
+ ## uint8 label targets and a sparse loss instead of one-hot float32 targets
+ 'sparse_labels' : True,
+
+ ## cut training patches on the fly from the full images instead of using the stakk.
+ ## n_patches is then the number of patches per epoch and n_patches//split patches are drawn once for validation.
+ 'random_patches' : False,
+ 'grey_glob'  : 'data3/labeled_data_membranes/images_big/smaller2x/*.tif',
+ 'label_glob' : 'data3/labeled_data_membranes/labels_big/smaller2x/*.tif',
+ 'patch_width' : 256,
+ ## corners of membrane weighted patches are resolved to membrane_grid pixels
+ 'membrane_grid' : 16,
 }
 
 def fix_labels(Y):
@@ -79,35 +100,43 @@ def learn_background(Y):
     Y[Y==4]=0
     return Y
 
+def prepare_XY(xs, ys, norm={}):
+    "norm are the keyword args for unet.normalize_X"
+    xs = unet.normalize_X(xs, **norm)
+    ys = ys.astype('uint16')
+    ys = fix_labels(ys)
+    #ys = learn_background(ys)
+    return xs, ys
+
+def patch_norm(stats, inds, norm):
+    "unet.normalize_X args for the patches inds, from their precomputed stats (see chunkstore.patch_stats)"
+    if norm == 'percentile':
+        return {'mode' : 'percentile', 'lo' : stats['p1'][inds], 'hi' : stats['p99'][inds]}
+    if norm == 'mode':
+        return {'mode' : 'mode', 'lo' : stats['p1'][inds], 'hi' : stats['p99'][inds], 'center' : stats['p50'][inds]}
+    return {}
+
 def build_XY(train_params):
     """
     returns X,Y train & vali
+    train_params['stakk'] is a stakk tif or a chunked stakk directory (see chunkstore).
     """
-    stakk = io.imread(train_params['stakk'])
     n_patches = train_params.get('n_patches', -1)
     split = train_params.get('split', 7)
 
-    ## Only train on a fraction of data
-    if n_patches==-1:
-        n_patches=stakk.shape[0]
-    # stakk = stakk[[9,10]]
-
-    ## Load and prepare
-    xs = stakk[:,0]
-    ys = stakk[:,1]
-
-    xs = xs.astype('float32')
-    xs = unet.normalize_X(xs)
-    ys = ys.astype('uint16')
-    ys = fix_labels(ys)
-    #ys = learn_background(ys)
-
-    ## select data by characteristics
-    # xmask = xs.mean(axis=(1,2))>0.6 # bright
-    y_mem = ys.sum(axis=(1,2)) # have membrane
-    y_mem_sort = np.argsort(y_mem)
-    xs = xs[y_mem_sort][-n_patches:]
-    ys = ys[y_mem_sort][-n_patches:]
+    ## select patches by the per-patch stats index (see chunkstore.patch_stats),
+    ## then read and normalize only the selected patches
+    # xmask = stats['p50']>0.6 # bright
+    if chunkstore.is_chunked(train_params['stakk']):
+        stakk = chunkstore.ChunkedStakk(train_params['stakk'])
+        stats = stakk.meta
+        read = lambda inds: stakk[inds]
+    else:
+        stats = chunkstore.tif_stakk_stats(train_params['stakk'])
+        read = lambda inds: chunkstore.read_tif_stakk(train_params['stakk'], inds)
+    selected = np.sort(chunkstore.top_k(stats['n_membrane'], n_patches)) # have membrane
+    stakk = read(selected)
+    xs, ys = prepare_XY(stakk[:,0], stakk[:,1], patch_norm(stats, selected, train_params.get('norm', 'patchwise')))
 
     ## take random subset
     # inds = np.arange(stakk.shape[0])
@@ -142,6 +171,23 @@ def build_XY(train_params):
     
     return X_train, X_vali, Y_train, Y_vali
 
+def build_random_source(train_params):
+    """
+    returns source, X_vali, Y_vali. See samplers.RandomPatchSource.
+    NOTE: the validation patches come from the same images as the training patches.
+    """
+    tp = train_params
+    w = tp['patch_width']
+    norm = tp.get('norm', 'patchwise')
+    source = samplers.RandomPatchSource(datasets.sglob(tp['grey_glob']), datasets.sglob(tp['label_glob']), (w, w),
+                                        grid=tp['membrane_grid'], membrane_labels=(1,2), label_fn=fix_labels,
+                                        norm=None if norm == 'patchwise' else norm, normalize_fn=unet.normalize_X)
+    X_vali, Y_vali = source.sample(tp['n_patches'] // tp['split'])
+    if norm == 'patchwise':
+        X_vali = unet.normalize_X(X_vali)
+    Y_vali = Y_vali.astype('uint16')
+    return source, X_vali, Y_vali
+
 def get_model(train_params):
     model = unet.get_unet_n_pool(train_params['n_pool'],
                              n_classes = train_params['n_classes'],
@@ -158,9 +204,16 @@ def train(train_params):
 
     train_params['rationale'] = rationale
 
-    X_train, X_vali, Y_train, Y_vali = build_XY(train_params)
+    if train_params['random_patches']:
+        source, X_vali, Y_vali = build_random_source(train_params)
+        X_train, Y_train = None, None
+        n_train = train_params['n_patches']
+    else:
+        source = None
+        X_train, X_vali, Y_train, Y_vali = build_XY(train_params)
+        n_train = X_train.shape[0]
 
-    train_params['batches_per_epoch'], _ = divmod(X_train.shape[0], train_params['batch_size'])
+    train_params['batches_per_epoch'], _ = divmod(n_train, train_params['batch_size'])
     json.dump(train_params, open(train_params['savedir'] + '/train_params.json', 'w'))
 
     def print_description(X,Y):
@@ -171,7 +224,8 @@ def train(train_params):
         print(Y.min(), Y.max())
         print("Nans?:", np.isnan(X.flatten()).sum())
 
-    print_description(X_train, Y_train)
+    if X_train is not None:
+        print_description(X_train, Y_train)
     print_description(X_vali, Y_vali)
 
     ## BUILD THE MODEL, MAYBE LOAD PRETRAINED WEIGHTS.
@@ -180,14 +234,14 @@ def train(train_params):
 
     ## MAGIC HAPPENS HERE
     begin_training_time = time.time()
-    history = unet.train_unet(X_train, Y_train, X_vali, Y_vali, model, train_params)
+    history = unet.train_unet(X_train, Y_train, X_vali, Y_vali, model, train_params, source)
     finished_time = time.time()
 
     ## MAGIC FINISHED, NOW SAVE TIMINGS
     history.history['warm_up_time'] = begin_training_time - start_time
     train_time = finished_time - begin_training_time
     history.history['train_time'] = train_time
-    trained_epochs = len(history.history['acc'])
+    trained_epochs = len(history.history['loss'])
     history.history['trained_epochs'] = trained_epochs
     history.history['avg_time_per_epoch'] = train_time / trained_epochs
     history.history['avg_time_per_batch'] = train_time / (trained_epochs * train_params['batches_per_epoch'])
@@ -16,26 +16,43 @@ from keras.optimizers import Adam, SGD
 from keras.callbacks import ModelCheckpoint, LearningRateScheduler, EarlyStopping, TensorBoard
 from keras import backend as K
 from keras.utils import np_utils
+from keras.utils import Sequence
 from keras.preprocessing.image import ImageDataGenerator
 
+import os
+import random
 import warping
 import patchmaker
+import samplers
 import datasets
 
-def normalize_X(X):
-    # normalize min and max over X per patch to [0,1]
+def normalize_X(X, mode='minmax', lo=None, hi=None, center=None, clip=False):
+    """
+    Normalize a stack of patches X (N, a, b), as one fused affine transform X*scale + offset.
+    mode='minmax'    : min and max over each patch to [0,1] (the default, computed here).
+    mode='percentile': lo -> 0 and hi -> 1.
+    mode='mode'      : center (the histogram mode) -> 0.5, with scale 1/(hi - lo).
+    lo, hi and center are scalars (per image, see normstats.image_norm) or arrays of shape (N,)
+    (per patch, e.g. the p1 / p50 / p99 in the chunkstore stats), so no percentiles are computed here.
+    """
     X = X.astype('float32')
-    mi = np.amin(X,axis = (1,2), keepdims = True)
+    if mode == 'minmax':
+        lo = np.amin(X, axis=(1,2), keepdims=True)
+        hi = np.amax(X, axis=(1,2), keepdims=True)
+    else:
+        lo = np.reshape(lo, (-1, 1, 1)).astype(np.float32)
+        hi = np.reshape(hi, (-1, 1, 1)).astype(np.float32)
     #mi = np.percentile(X, 1, axis = (1,2), keepdims = True)
-    #mi = np.percentile(X, 1)
     #mi = X.min()
-    X -= mi
-    ma = np.amax(X,axis = (1,2), keepdims = True) + 1.e-10
-    #ma = np.percentile(X, 99, axis = (1,2), keepdims = True) + 1.e-10
-    #ma = np.percentile(X, 99) + 1.e-10
-    #ma = X.max()
-    X /= ma
-    #X = np.clip(X, 0, 1)
+    scale = 1 / (hi - lo + 1.e-10)
+    if mode == 'mode':
+        offset = 0.5 - np.reshape(center, (-1, 1, 1)).astype(np.float32) * scale
+    else:
+        offset = -lo * scale
+    X *= scale
+    X += offset
+    if clip:
+        X = np.clip(X, 0, 1, out=X)
     return X
 
 def labels_to_activations(Y, n_classes=2):
@@ -46,6 +63,10 @@ def labels_to_activations(Y, n_classes=2):
     Y = Y.reshape(a, b, c, n_classes)
     return Y.astype(np.float32)
 
+def labels_to_sparse(Y):
+    "integer labels (a, b, c) -> uint8 (a, b, c, 1), the targets for my_sparse_categorical_crossentropy"
+    return Y.astype(np.uint8)[..., np.newaxis]
+
 def add_singleton_dim(X):
     """
     backend [theano, tensorflow] dependent
@@ -80,6 +101,32 @@ def my_categorical_crossentropy(weights=(1., 1.), itd=1, BEnd=K):
         return result
     return catcross
 
+def my_sparse_categorical_crossentropy(weights=(1., 1.), itd=1, n_classes=2):
+    """
+    my_categorical_crossentropy for integer labels y_true.shape = (N, a, b, 1) (see labels_to_sparse),
+    instead of one-hot activations. Same class weights and same valid region (itd).
+    Each pixel's log-probability is gathered from the flattened prediction by its label.
+    """
+    weights = K.constant(np.array(weights, dtype=np.float32))
+    eps  = K.epsilon()
+    def sparsecatcross(y_true, y_pred):
+        yt = K.cast(K.flatten(y_true[:,itd:-itd,itd:-itd,0]), 'int32')
+        yp = y_pred[:,itd:-itd,itd:-itd,:]
+        logp = K.reshape(K.log(yp + eps), (-1,))
+        inds = K.arange(0, K.shape(yt)[0]) * n_classes + yt
+        ## NOTE: the weighted mean over pixels equals the sum over classes of weight * mean one-hot cross-entropy
+        ce = K.gather(weights, yt) * K.gather(logp, inds)
+        return -K.mean(ce)
+    return sparsecatcross
+
+def acc(y_true, y_pred):
+    """
+    pixel accuracy for integer labels y_true (N, a, b, 1), the same number keras' 'accuracy' gives for one-hot labels.
+    Named acc so the history keeps the keys 'acc' / 'val_acc' (see summarize_models.py).
+    """
+    yt = K.cast(y_true[...,0], 'int64')
+    return K.mean(K.cast(K.equal(yt, K.argmax(y_pred, axis=-1)), K.floatx()))
+
 def get_unet_n_pool(n_pool, n_classes=2, n_convolutions_first_layer=32, dropout_fraction=0.2):
     """
     The info travel distance is given by info_travel_dist(n_pool, 3)
@@ -180,13 +227,37 @@ def info_travel_dist(n_maxpool, conv=3):
         width -= conv2
     return int(-width/2)
 
+def activation_bytes(shape, n_pool, n_convolutions_first_layer=32, n_classes=2, batch_size=1):
+    """
+    Upper bound on the float32 activation memory of get_unet_n_pool for an input of shape (x, y).
+    Counts every layer output as if nothing were freed during the forward pass.
+    """
+    px = shape[0] * shape[1]
+    s = n_convolutions_first_layer
+    total = px # input
+    for l in range(n_pool):
+        # conv, dropout, conv at this level, then the pooled output
+        total += (3*s*2**l + s*2**l/4) * px/4**l
+    # the flat bottom: conv, dropout, conv
+    total += 3*s*2**n_pool * px/4**n_pool
+    for l in range(n_pool):
+        # upsampling (2c), concatenation (3c), conv, dropout, conv (c each)
+        total += 8*s*2**l * px/4**l
+    # final 1x1 conv and softmax
+    total += 2*n_classes*px
+    return int(4 * total * batch_size)
+
 # ---- PUBLIC INTERFACE ----
 
-def train_unet(X_train, Y_train, X_vali, Y_vali, model, train_params):
+def train_unet(X_train, Y_train, X_vali, Y_vali, model, train_params, source=None):
+    """
+    source: a samplers.RandomPatchSource. If given, the training batches are cut from it on the fly
+    (X_train and Y_train may be None) and the class weights come from the validation labels.
+    """
     tp = train_params
 
     print("COMPUTE CLASSWEIGHTS")
-    _, counts = np.unique(Y_train, return_counts=True)
+    _, counts = np.unique(Y_train if source is None else Y_vali, return_counts=True)
     weights = (1-counts/counts.sum())/(len(counts)-1)
     print("ClassWeights:", weights)
 
@@ -196,24 +267,41 @@ def train_unet(X_train, Y_train, X_vali, Y_vali, model, train_params):
     elif tp['optimizer'] == 'adam':
         optim = Adam(lr = tp['learning_rate'])
 
-    model.compile(optimizer=optim, loss=my_categorical_crossentropy(weights=weights, itd=tp['itd']), metrics=['accuracy'])
+    if tp.get('sparse_labels', False):
+        loss = my_sparse_categorical_crossentropy(weights=weights, itd=tp['itd'], n_classes=tp['n_classes'])
+        metrics = [acc]
+    else:
+        loss = my_categorical_crossentropy(weights=weights, itd=tp['itd'])
+        metrics = ['accuracy']
+    model.compile(optimizer=optim, loss=loss, metrics=metrics)
 
     print("SETUP CALLBACKS")
     checkpointer = ModelCheckpoint(filepath=tp['savedir'] + "/unet_model_weights_checkpoint.h5", verbose=0, save_best_only=True, save_weights_only=True)
     earlystopper = EarlyStopping(patience=tp['patience'], verbose=0)
     callbacks = [checkpointer, earlystopper]
 
+    if source is None:
+        sequence = PatchSequence(X_train, Y_train, train_params)
+    else:
+        sequence = RandomPatchSequence(source, train_params)
+    workers = tp.get('workers', 1)
     history = model.fit_generator(
-                batch_generator_patches(X_train, Y_train, train_params),
+                sequence,
                 steps_per_epoch=tp['batches_per_epoch'],
                 epochs=tp['epochs'],
                 verbose=1,
                 callbacks=callbacks,
-                validation_data=(add_singleton_dim(X_vali), labels_to_activations(Y_vali, tp['n_classes'])))
+                workers=workers,
+                use_multiprocessing=workers > 1,
+                max_queue_size=tp.get('max_queue_size', 10),
+                validation_data=(add_singleton_dim(X_vali), labels_to_targets(Y_vali, tp)))
 
     print("FINISHED TRAINING")
 
-    history.history['X_train_shape'] = X_train.shape
+    if source is None:
+        history.history['X_train_shape'] = X_train.shape
+    else:
+        history.history['X_train_shape'] = (tp['batches_per_epoch'] * tp['batch_size'],) + source.shape
     history.history['X_vali_shape'] = X_vali.shape
 
     if False:
@@ -247,41 +335,117 @@ def train_unet(X_train, Y_train, X_vali, Y_vali, model, train_params):
 
     return history
 
+def labels_to_targets(Y, train_params):
+    "the training targets: uint8 labels if train_params['sparse_labels'] else one-hot float32 activations"
+    if train_params.get('sparse_labels', False):
+        return labels_to_sparse(Y)
+    return labels_to_activations(Y, train_params['n_classes'])
+
+def augment_batch(Xbatch, Ybatch, train_params, Dbatch=None, seeds=None):
+    """
+    Randomly augment the batch (see warping.randomly_augment_batch),
+    then normalize the whole batch once.
+    Dbatch are the (cached) membrane distance maps of Ybatch, seeds the per-patch warp seeds.
+    """
+    tp = train_params
+    Xbatch, Ybatch = warping.randomly_augment_batch(Xbatch, Ybatch, tp['noise'], tp['flipLR'], tp['warping_size'], tp['rotate_angle_max'], D=Dbatch, seeds=seeds)
+    ## other normalizations are applied once, when the data is loaded (see train.build_XY)
+    if tp.get('norm', 'patchwise') == 'patchwise':
+        Xbatch = normalize_X(Xbatch)
+    return Xbatch, Ybatch
+
+def reseed_in_worker(seq):
+    """
+    Worker processes are forked with identical random states, so every worker would produce the same
+    augmentations. Reseed from the OS once in each new process. The process that built seq
+    keeps its random state, so a seed set by the user still makes single process runs reproducible.
+    """
+    if os.getpid() != seq.pid:
+        seq.pid = os.getpid()
+        np.random.seed()
+        random.seed()
+
+class PatchSequence(Sequence):
+    """
+    The training batches as a keras Sequence, so fit_generator can build them in parallel
+    in tp['workers'] processes and prefetch up to tp['max_queue_size'] batches.
+    The patches of each batch are chosen by a sampler (see samplers.get_sampler) and gathered
+    into reused buffers, so shuffling never copies the training set.
+    The membrane distance maps of the labels never change, so they're computed once here
+    (before the workers fork) instead of on every batch.
+    """
+    def __init__(self, X, Y, train_params):
+        self.X = X
+        self.Y = Y
+        self.D = warping.membrane_distance(Y)
+        self.tp = train_params
+        self.pid = os.getpid()
+        self.sampler = samplers.get_sampler(Y, train_params)
+        bs = train_params['batch_size']
+        self.buffers = [samplers.batch_buffer(A, bs) for A in (X, Y, self.D)]
+
+    def __len__(self):
+        return self.tp['batches_per_epoch']
+
+    def __getitem__(self, idx):
+        reseed_in_worker(self)
+        inds = self.sampler.batch_indices(idx)
+        Xbatch, Ybatch, Dbatch = [samplers.gather_batch(A, inds, buf) for A, buf in zip((self.X, self.Y, self.D), self.buffers)]
+        Xbatch, Ybatch = augment_batch(Xbatch, Ybatch, self.tp, Dbatch)
+        return add_singleton_dim(Xbatch), labels_to_targets(Ybatch, self.tp)
+
+    def on_epoch_end(self):
+        self.sampler.on_epoch_end()
+
+class RandomPatchSequence(Sequence):
+    """
+    Like PatchSequence, but every batch is freshly cut from the full images of a samplers.RandomPatchSource,
+    so no two epochs see the same patches. The label distance maps can't be cached here.
+    """
+    def __init__(self, source, train_params):
+        self.source = source
+        self.tp = train_params
+        self.pid = os.getpid()
+        bs = train_params['batch_size']
+        self.buffers = (np.empty((bs,) + source.shape, dtype=source.grey_dtype()),
+                        np.empty((bs,) + source.shape, dtype=source.labels[0].dtype))
+
+    def __len__(self):
+        return self.tp['batches_per_epoch']
+
+    def __getitem__(self, idx):
+        reseed_in_worker(self)
+        Xbatch, Ybatch = self.source.sample(self.tp['batch_size'], self.buffers)
+        Xbatch, Ybatch = augment_batch(Xbatch, Ybatch, self.tp)
+        return add_singleton_dim(Xbatch), labels_to_targets(Ybatch, self.tp)
+
 def batch_generator_patches(X, Y, train_params, verbose=False):
     epoch = 0
     tp = train_params
+    D = warping.membrane_distance(Y)
+    sampler = samplers.get_sampler(Y, tp)
+    buffers = [samplers.batch_buffer(A, tp['batch_size']) for A in (X, Y, D)]
     while (True):
         epoch += 1
-        current_idx = 0
         batchnum = 0
-        inds = np.arange(X.shape[0])
-        np.random.shuffle(inds)
-        X = X[inds]
-        Y = Y[inds]
         while batchnum < tp['batches_per_epoch']:
-            Xbatch, Ybatch = X[current_idx:current_idx + tp['batch_size']].copy(), Y[current_idx:current_idx + tp['batch_size']].copy()
+            inds = sampler.batch_indices(batchnum)
+            Xbatch, Ybatch, Dbatch = [samplers.gather_batch(A, inds, buf) for A, buf in zip((X, Y, D), buffers)]
             # io.imsave('X.tif', Xbatch, plugin='tifffile')
             # io.imsave('Y.tif', Ybatch, plugin='tifffile')
 
-            current_idx += tp['batch_size']
-
-            for i in range(Xbatch.shape[0]):
-                x = Xbatch[i]
-                y = Ybatch[i]
-                x,y = warping.randomly_augment_patches(x, y, tp['noise'], tp['flipLR'], tp['warping_size'], tp['rotate_angle_max'])
-                Xbatch[i] = x
-                Xbatch = normalize_X(Xbatch)
-                Ybatch[i] = y
+            Xbatch, Ybatch = augment_batch(Xbatch, Ybatch, tp, Dbatch)
 
             # io.imsave('Xauged.tif', Xbatch.astype('float32'), plugin='tifffile')
             # io.imsave('Yauged.tif', Ybatch.astype('float32'), plugin='tifffile')
 
             Xbatch = add_singleton_dim(Xbatch)
-            Ybatch = labels_to_activations(Ybatch, tp['n_classes'])
+            Ybatch = labels_to_targets(Ybatch, tp)
 
             # print('xshape', Xbatch.shape)
             # print('yshape', Ybatch.shape)
 
             batchnum += 1
             yield Xbatch, Ybatch
+        sampler.on_epoch_end()
 
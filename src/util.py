@@ -3,6 +3,10 @@ import skimage.io as io
 
 from glob import glob
 import os
+import hashlib
+import json
+import time
+import multiprocessing
 
 def sglob(string):
     return sorted(glob(string))
@@ -33,28 +37,127 @@ def path_base_ext(fname):
     base, ext = os.path.splitext(base)
     return directory, base, ext
 
+def file_hash(fname, blocksize=2**20):
+    "sha1 hex digest of the contents of fname, read a block at a time"
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
 def safe_makedirs(dirpath):
     if not os.path.exists(dirpath):
         os.makedirs(dirpath)
 
-def apply_operation_to_imgdir(imgdir, func, dtype='input', ext='.tif', inplace=False):
-    "apply func to every img in dir, then save to new subdir."
-    for file in glob(imgdir + "/*" + ext):
+def func_id(func):
+    "name of func plus a hash of its code, so editing the function invalidates its outputs"
+    code = getattr(func, '__code__', None)
+    h = hashlib.sha1()
+    if code is not None:
+        h.update(code.co_code)
+        h.update(repr([c for c in code.co_consts if not hasattr(c, 'co_code')]).encode())
+    return getattr(func, '__qualname__', func.__name__) + ':' + h.hexdigest()[:12]
+
+def _output_name(file, func, ext, inplace):
+    path, base, _ = path_base_ext(file)
+    if inplace:
+        return path + os.sep + base + ext
+    return path + os.sep + func.__name__ + os.sep + base + ext
+
+## set before the worker pool forks, so func may be a closure or lambda (which can't be pickled).
+## This only works with fork, so the pool always uses the fork start method (not the macOS default, spawn).
+_job = {}
+
+def _apply_one(file):
+    j = _job
+    t = time.time()
+    try:
+        st_in = os.stat(file)
         img = io.imread(file)
-        path, base, _ = path_base_ext(file)
-        result_img = func(img)
+        input_hash = file_hash(file)
+        result_img = j['func'](img)
         # result_img = np.concatenate((img, result_img[:,:, np.newaxis]), axis=2)
-        if inplace:
-            new_img_name = path + os.sep + base + ext
-        else:
-            newpath = path + os.sep + func.__name__ + os.sep
-            safe_makedirs(newpath)
-            new_img_name = newpath + base + ext
-        print("Saving to: ", new_img_name)
-        if dtype == 'input':
-            io.imsave(new_img_name, result_img, compress=1)
-        else:
-            io.imsave(new_img_name, result_img.astype(dtype), compress=1)
+        new_img_name = _output_name(file, j['func'], j['ext'], j['inplace'])
+        safe_makedirs(os.path.dirname(new_img_name))
+        if j['dtype'] != 'input':
+            result_img = result_img.astype(j['dtype'])
+        io.imsave(new_img_name, result_img, compress=j['compress'])
+        st = os.stat(new_img_name)
+        entry = {'input_hash' : input_hash, 'input_mtime' : st_in.st_mtime, 'input_size' : st_in.st_size,
+                 'func' : j['func_id'], 'dtype' : j['dtype'],
+                 'output' : new_img_name, 'output_mtime' : st.st_mtime, 'output_size' : st.st_size}
+        return file, entry, None, time.time() - t
+    except Exception as e:
+        return file, None, repr(e), time.time() - t
+
+def _up_to_date(file, entry, fid, dtype, inplace):
+    if not entry or entry['func'] != fid or entry['dtype'] != dtype:
+        return False
+    out = entry['output']
+    if not os.path.exists(out):
+        return False
+    st = os.stat(out)
+    if (st.st_mtime, st.st_size) != (entry['output_mtime'], entry['output_size']):
+        return False
+    ## inplace, the input is the output we wrote
+    if inplace:
+        return True
+    ## only hash inputs whose size or mtime changed (e.g. touched, or copied back)
+    st = os.stat(file)
+    if (st.st_mtime, st.st_size) == (entry.get('input_mtime'), entry.get('input_size')):
+        return True
+    if file_hash(file) != entry['input_hash']:
+        return False
+    entry['input_mtime'], entry['input_size'] = st.st_mtime, st.st_size
+    return True
+
+def _save_manifest(manifest, manifest_name):
+    tmp = manifest_name + '.tmp'
+    json.dump(manifest, open(tmp, 'w'), indent=1)
+    os.replace(tmp, manifest_name)
+
+def apply_operation_to_imgdir(imgdir, func, dtype='input', ext='.tif', inplace=False, n_procs=1, compress=1, force=False):
+    """
+    apply func to every img in dir, then save to new subdir (imgdir/func.__name__/, or over the input if inplace).
+    Runs in n_procs forked worker processes. A manifest (imgdir/.manifest_<func name>.json) records the input
+    hash, size and mtime, the function (see func_id) and the output of every file, and up-to-date outputs are
+    skipped unless force. Inputs are only hashed again when their size or mtime changed.
+    A failing file is reported and skipped, the rest of the batch goes on.
+    returns the list of (file, error) for the files which failed
+    """
+    fid = func_id(func)
+    manifest_name = os.path.join(imgdir, '.manifest_{}.json'.format(func.__name__))
+    manifest = json.load(open(manifest_name)) if os.path.exists(manifest_name) else {}
+    files = sorted(glob(imgdir + "/*" + ext))
+    todo = [f for f in files if force or not _up_to_date(f, manifest.get(f), fid, dtype, inplace)]
+    print("{}: {} files, {} up to date, {} to do".format(func.__name__, len(files), len(files) - len(todo), len(todo)))
+    ## keep the input mtimes refreshed by _up_to_date, so their hashes aren't checked again next time
+    if manifest:
+        _save_manifest(manifest, manifest_name)
+
+    _job.update(func=func, func_id=fid, dtype=dtype, ext=ext, inplace=inplace, compress=compress)
+    if n_procs > 1:
+        pool = multiprocessing.get_context('fork').Pool(n_procs)
+        results = pool.imap_unordered(_apply_one, todo)
+    else:
+        results = map(_apply_one, todo)
+
+    failed = []
+    start = time.time()
+    for i, (file, entry, error, dt) in enumerate(results):
+        if error:
+            print("[{}/{}] FAILED {} ({:.2f}s): {}".format(i+1, len(todo), file, dt, error))
+            failed.append((file, error))
+            continue
+        print("[{}/{}] Saved to: {} ({:.2f}s)".format(i+1, len(todo), entry['output'], dt))
+        manifest[file] = entry
+        ## rewrite the manifest after every file, so an interrupted batch resumes where it stopped
+        _save_manifest(manifest, manifest_name)
+    if n_procs > 1:
+        pool.close()
+        pool.join()
+    print("Done in {:.1f}s, {} failed".format(time.time() - start, len(failed)))
+    return failed
 
 def count_nans(img):
     return np.count_nonzero(np.isnan(img))
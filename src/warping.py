@@ -4,7 +4,7 @@ import matplotlib.pyplot as plt
 plt.ion()
 from scipy.misc import imresize
 import skimage.transform as tform
-from scipy.ndimage import label, zoom, rotate, distance_transform_edt
+from scipy.ndimage import label, zoom, rotate, distance_transform_edt, map_coordinates
 import random
 
 structure = [[1,1,1], [1,1,1], [1,1,1]]
@@ -46,6 +46,190 @@ def unet_warp_orig(img, delta, twolabel=False):
         res = tform.warp(img, newcoords, order=1)
     return res, delta_big, coords
 
+## batched elastic warping. Instead of one imresize + tform.warp per patch (and again for its labels)
+## we build the dense displacement fields for the whole batch with two matrix products and resample
+## straight from those coordinates with map_coordinates, skipping tform.warp's conversions and checks.
+
+def _linear(x):
+    x = np.abs(x)
+    return np.where(x < 1, 1 - x, 0)
+
+def _cubic(x, a=-0.5):
+    x = np.abs(x)
+    return np.where(x < 1, ((a + 2)*x - (a + 3))*x*x + 1,
+           np.where(x < 2, (((x - 5)*x + 8)*x - 4)*a, 0))
+
+def upsample_matrix(n_in, n_out, kind='linear'):
+    """
+    (n_out, n_in) matrix which resizes a 1D signal the way PIL (and therefore scipy.misc.imresize) does:
+    pixel centers aligned and the filter weights renormalized at the edges.
+    kind = 'linear' (bilinear, imresize's default, used by unet_warp_orig) | 'cubic' (bicubic)
+    """
+    f = {'linear' : _linear, 'cubic' : _cubic}[kind]
+    center = (np.arange(n_out) + 0.5) * n_in / n_out
+    m = f(np.arange(n_in)[np.newaxis, :] + 0.5 - center[:, np.newaxis])
+    return m / m.sum(axis=1, keepdims=True)
+
+def dense_displacement_fields(deltas, shape, kind='linear'):
+    """
+    Upsample a batch of coarse displacement grids deltas.shape = (N, 2, g, h) to dense fields (N, 2, a, b)
+    with a single (separable) matrix product for the whole batch.
+    """
+    ma = upsample_matrix(deltas.shape[2], shape[0], kind).astype(np.float32)
+    mb = upsample_matrix(deltas.shape[3], shape[1], kind).astype(np.float32)
+    return np.matmul(ma, np.matmul(deltas.astype(np.float32), mb.T))
+
+def random_deltas(n, warping_size, grid=3, seeds=None):
+    """
+    n coarse (2, grid, grid) displacement grids, as in randomly_augment_patches: each sample gets
+    a random scale in [0, warping_size). If seeds (one per sample) are given, sample i is drawn from
+    np.random.RandomState(seeds[i]), so a warp can be reproduced from its seed.
+    """
+    if seeds is None:
+        scales = np.random.rand(n) * warping_size
+        return np.random.normal(size=(n, 2, grid, grid)) * scales[:, np.newaxis, np.newaxis, np.newaxis]
+    deltas = []
+    for s in seeds:
+        rs = np.random.RandomState(s)
+        deltas.append(rs.normal(loc=0, scale=rs.rand()*warping_size, size=(2, grid, grid)))
+    return np.array(deltas)
+
+def resample_batch(imgs, coords, order=1, cval=0):
+    """
+    imgs.shape = (N, a, b), coords.shape = (N, 2, a, b): for each output pixel, the (row, col) in the input to sample.
+    NOTE: a single 3D map_coordinates call over the stack (with the sample index as an extra coordinate)
+    is slower than this loop, and mixes neighbouring samples for spline orders > 1.
+    """
+    out = np.empty(coords[:, 0].shape, dtype=np.float32)
+    for i in range(imgs.shape[0]):
+        map_coordinates(imgs[i], coords[i], output=out[i], order=order, mode='constant', cval=cval)
+    return out
+
+def membrane_distance(labs):
+    """
+    Distance of every pixel to the nearest membrane (label 1) pixel, for a stack of label patches (N, a, b).
+    """
+    dis = np.empty(labs.shape, dtype=np.float32)
+    for i in range(labs.shape[0]):
+        dis[i] = distance_transform_edt(labs[i] != 1)
+    return dis
+
+def distance_to_labels(dis):
+    "threshold (warped) membrane distances back into labels: membrane=1, everything else 0 (like unet_warp_orig twolabel)"
+    return (dis <= 0.75).astype('uint8')
+
+def warp_batch(imgs, deltas, order=1, kind='linear'):
+    "warp a stack of images with the coarse displacement grids deltas (N, 2, g, g), see dense_displacement_fields"
+    coords = np.indices(imgs.shape[1:])[np.newaxis] + dense_displacement_fields(deltas, imgs.shape[1:], kind)
+    return resample_batch(imgs.astype(np.float32), coords, order=order)
+
+def warp_label_batch(labs, deltas, kind='linear'):
+    "warp a stack of label patches, via their membrane distance maps like unet_warp_orig(..., twolabel=True)"
+    dis = warp_batch(membrane_distance(labs), deltas, order=3, kind=kind)
+    return distance_to_labels(dis)
+
+## composable coordinate transforms. Each transform maps the coordinates at which the *output* is sampled to
+## coordinates in its own input. Composing them (output side first) gives one coordinate map from the
+## output patch straight to the original patch, so flip + warp + rotation cost a single interpolation.
+## A transform gets coords=None for the identity grid, which lets the first one skip work.
+
+def rotation_transform(angle, shape):
+    "rotation by angle (degrees) about the patch center, exactly like scipy.ndimage.rotate(reshape=False)"
+    c, s = np.cos(np.deg2rad(angle)), np.sin(np.deg2rad(angle))
+    center = (np.array(shape, dtype=np.float32) - 1) / 2
+    def transform(coords):
+        if coords is None:
+            coords = np.indices(shape, dtype=np.float32)
+        y, x = coords[0] - center[0], coords[1] - center[1]
+        return np.stack((c*y + s*x + center[0], -s*y + c*x + center[1]))
+    return transform
+
+def elastic_transform(field):
+    "elastic warp by the dense displacement field (2, a, b), like unet_warp_orig"
+    def transform(coords):
+        if coords is None:
+            return np.indices(field.shape[1:], dtype=np.float32) + field
+        ## the field is smooth, so linear interpolation between its pixels is plenty
+        delta = [map_coordinates(f, coords, order=1, mode='nearest') for f in field]
+        return coords + np.stack(delta)
+    return transform
+
+def flip_transform(shape, axis=1):
+    "mirror along axis (axis=1 is the horizontal axis)"
+    def transform(coords):
+        if coords is None:
+            coords = np.indices(shape, dtype=np.float32)
+        coords = coords.copy()
+        coords[axis] = shape[axis] - 1 - coords[axis]
+        return coords
+    return transform
+
+def compose_coords(transforms):
+    "the coordinate map of the transforms applied one after the other, listed from the output side"
+    coords = None
+    for t in transforms:
+        coords = t(coords)
+    return coords
+
+def augmentation_transforms(shape, flip, angle, field):
+    """
+    The transforms of randomly_augment_patches, in the same order (flip, then warp, then rotate),
+    listed from the output side for compose_coords.
+    """
+    transforms = []
+    if angle:
+        transforms.append(rotation_transform(angle, shape))
+    if field is not None:
+        transforms.append(elastic_transform(field))
+    if flip:
+        transforms.append(flip_transform(shape, axis=1))
+    return transforms
+
+def randomly_augment_batch(X, Y, noise, flipLR, warping_size, rotate_angle_max, order=1, D=None, seeds=None):
+    """
+    randomly_augment_patches for a whole batch X.shape = Y.shape = (N, a, b).
+    The flip, elastic warp and rotation of each patch are fused into a single coordinate map
+    (see augmentation_transforms), so every patch and its labels are interpolated only once.
+    The labels are interpolated via their membrane distance maps, like unet_warp_orig(twolabel=True).
+    Pass the precomputed membrane_distance(Y) as D to skip the distance transforms.
+    seeds (one per sample) seed the elastic displacement fields, see random_deltas.
+    """
+    X = X.astype(np.float32)
+    n, a, b = X.shape
+    if noise:
+        for i in range(n):
+            patch = X[i]
+            m = random.random()*patch.mean()
+            s = random.random()*patch.std()
+            ## rescale back to the patch's own range, so X keeps its normalization (see unet.normalize_X)
+            lo, hi = patch.min(), patch.max()
+            patch += np.random.normal(m,s,patch.shape).astype(patch.dtype)/4
+            patch -= patch.min()
+            patch *= (hi - lo) / patch.max()
+            patch += lo
+
+    fields = dense_displacement_fields(random_deltas(n, warping_size, seeds=seeds), (a, b))
+    coords = np.empty((n, 2, a, b), dtype=np.float32)
+    for i in range(n):
+        flip = flipLR and random.random()<0.5
+        angle = (random.random()-0.5)*2*rotate_angle_max
+        coords[i] = compose_coords(augmentation_transforms((a, b), flip, angle, fields[i]))
+
+    X = resample_batch(X, coords, order=order)
+    if D is None:
+        D = membrane_distance(Y)
+    Y = resample_labels(D, coords, order=order)
+    return X, Y
+
+def resample_labels(D, coords, order=1):
+    """
+    labels from the membrane distance maps D (N, a, b) resampled at coords (N, 2, a, b).
+    Pixels from outside the patch (e.g. the corners of a rotation) get a distance larger than any
+    inside the patch, so they stay background, like the zero fill of ndimage.rotate on the labels.
+    """
+    far = float(D.shape[1] + D.shape[2])
+    return distance_to_labels(resample_batch(D, coords, order=order, cval=far))
+
 def plot_vector_field(img):
     """
     only designed to be the right scale for smooth warps of roughly 500^2 image patches.
@@ -66,13 +66,16 @@ def idea1():
     order = np.argsort(cts)[::-1]
     seg_clean = seg==ids[order][1]
 
-def idea2():
+def idea2(grey_name):
     idea = """
     Try different normalization schemes, including adaptive local histogram equalization.
     """
+    import skimage.exposure as exposure
+    import preproc_cache
     imglist = []
     for d in [20,40,80]:
-        imglist.append(exposure.equalize_adapthist(grey, [d,d]))
+        imglist.append(preproc_cache.cached(grey_name, exposure.equalize_adapthist, kernel_size=[d,d]))
+    return imglist
 
 goals = """
 We want the best view of our results overlayed with the original image and the ground truth.
@@ -119,6 +122,14 @@ def compute_uncertainty(img_names, dirs):
         qsave(np.stack([img, img_mean, img_std, img_min, img_min_thresh, img_max]), name=(base + '_one.tif'))
         qsave(np.stack([img, img_min]), name=(base + '_two.tif'))
 
+def compute_uncertainty_ensemble(grey_names, dirs, savedir='./'):
+    """
+    Like compute_uncertainty, but runs every model in dirs over the greyscale images in a single pass with
+    running statistics (see predict.predict_ensemble), instead of reading back and stacking one saved prediction per model.
+    """
+    import predict
+    predict.predict_ensemble(dirs, grey_names, savedir)
+
 def img_to_levels(img, levels=[0.5]):
     """
     split a continuous value image into discrete levels with uint values